@@ -0,0 +1,42 @@
+"""
+Benchmark running [[ ]] blocks against storages with many keys
+
+Usage: python benchmarks/exec_storage.py [number of keys]
+"""
+import sys
+import time
+import asyncio
+import tempfile
+import os.path
+from rememberscript.strings import process_action
+from rememberscript.storage import FileStorage
+
+ACTION = '[[count = count + 1]][[last = msg]]'
+ITERATIONS = 10000
+
+
+async def run(storage, n_keys: int) -> float:
+    for i in range(n_keys):
+        storage['key%i' % i] = [i]
+    storage['count'] = 0
+    storage['msg'] = 'hello'
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        async for _ in process_action(ACTION, storage):
+            pass
+    return time.perf_counter() - start
+
+
+async def main(n_keys: int) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        storages = [('dict', {}),
+                    ('FileStorage', FileStorage(os.path.join(path, 'storage.bin')))]
+        for name, storage in storages:
+            elapsed = await run(storage, n_keys)
+            print('%-12s %6i keys: %8.2f us per action' % (
+                name, n_keys, elapsed / ITERATIONS * 1e6))
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
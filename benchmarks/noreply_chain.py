@@ -0,0 +1,48 @@
+"""
+Benchmark replies that go through chains of noreply states, the time per
+state should stay the same as chains get longer
+
+Usage: python benchmarks/noreply_chain.py [max chain length]
+"""
+import sys
+import time
+import asyncio
+from rememberscript import RememberMachine
+
+MESSAGES = 20000
+
+
+def chain_script(length: int) -> dict:
+    """A script where 'go' leads through length noreply states, that each
+    reply once, and then back to init"""
+    states = [{'name': 'init', '=?>': {'?': 'go', '=>': 'state0'}}]
+    for i in range(length):
+        states.append({'name': 'state%i' % i, '=>+': 'state%i' % i, 'noreply': True,
+                       '=?>': {'=>': 'next'}})
+    states.append({'name': 'end', '=>+': 'end', '=?>': {'=>': 'init'}})
+    return {'init': states}
+
+
+async def run(length: int) -> float:
+    machine = RememberMachine(chain_script(length))
+    machine.init()
+    n_replies = 0
+    start = time.perf_counter()
+    for _ in range(max(1, MESSAGES // (length + 1))):
+        async for _ in machine.replies('go'):
+            n_replies += 1
+        async for _ in machine.replies(''):
+            pass
+    return (time.perf_counter() - start) / n_replies
+
+
+async def main(max_length: int) -> None:
+    length = 1
+    while length <= max_length:
+        elapsed = await run(length)
+        print('chain of %6i states: %8.2f us per reply' % (length, elapsed * 1e6))
+        length *= 10
+
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000))
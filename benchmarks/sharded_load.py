@@ -0,0 +1,55 @@
+"""
+Simulated load of many concurrent sessions on a ShardedPool
+
+Usage: python benchmarks/sharded_load.py [workers] [sessions] [messages]
+"""
+import sys
+import time
+import random
+import asyncio
+import os.path
+import tempfile
+from rememberscript.sharding import ShardedPool
+
+# A script with many regex triggers that loops in the init state
+N_TRIGGERS = 200
+SCRIPT = '- name: init\n  =?>:\n' + ''.join(
+    '    - ?: "(?:hello|hi) (\\\\w+) %i( please)?"\n'
+    '      =>: loopback\n'
+    '      +: "hi {{match0}} %i"\n' % (i, i) for i in range(N_TRIGGERS))
+MESSAGES = ['hello you %i' % i for i in range(0, N_TRIGGERS, 7)]
+
+
+async def session(pool: ShardedPool, session_id: str, n_messages: int) -> int:
+    replies = 0
+    for _ in range(n_messages):
+        async for _ in pool.reply(session_id, random.choice(MESSAGES)):
+            replies += 1
+    return replies
+
+
+async def run(pool: ShardedPool, workers: int, n_sessions: int, n_messages: int) -> None:
+    start = time.perf_counter()
+    replies = await asyncio.gather(*[session(pool, 's%i' % i, n_messages)
+                                     for i in range(n_sessions)], return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    await pool.close()
+
+    errors = sum(1 for r in replies if isinstance(r, Exception))
+    print('%i workers: %i messages in %.2f s, %.0f messages/s, %i sessions failed' % (
+        workers, n_sessions * n_messages, elapsed, n_sessions * n_messages / elapsed, errors))
+
+
+def main(workers: int, n_sessions: int, n_messages: int) -> None:
+    with tempfile.TemporaryDirectory() as path:
+        with open(os.path.join(path, 'init.yaml'), 'w') as f:
+            f.write(SCRIPT)
+        # The workers are forked before the event loop runs
+        pool = ShardedPool(path, workers=workers)
+        pool.start()
+    asyncio.run(run(pool, workers, n_sessions, n_messages))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:] + [None] * 3
+    main(int(args[0] or 4), int(args[1] or 1000), int(args[2] or 10))
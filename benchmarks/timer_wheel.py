@@ -0,0 +1,31 @@
+"""
+Benchmark scheduling and cancelling many pending timers on a TimerWheel
+
+Usage: python benchmarks/timer_wheel.py [number of timers]
+"""
+import sys
+import time
+import random
+import asyncio
+from rememberscript.timers import TimerWheel
+
+
+async def main(n_timers: int) -> None:
+    wheel = TimerWheel(resolution=0.1)
+    delays = [random.uniform(1, 24 * 3600) for _ in range(n_timers)]
+
+    start = time.perf_counter()
+    timers = [wheel.schedule(delay, print) for delay in delays]
+    elapsed = time.perf_counter() - start
+    print('schedule %i timers: %.2f us per timer' % (n_timers, elapsed / n_timers * 1e6))
+
+    start = time.perf_counter()
+    for timer in timers:
+        timer.cancel()
+    elapsed = time.perf_counter() - start
+    print('cancel %i timers:   %.2f us per timer' % (n_timers, elapsed / n_timers * 1e6))
+    wheel.stop()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000))
@@ -1,3 +1,12 @@
 from .machine import RememberMachine
-from .script import load_script, load_scripts_dir, validate_script
+from .messages import Message
+from .script import load_script, load_scripts_dir, validate_script, compile_script
 from .storage import FileStorage
+from .serializers import CodecRegistry
+from .sqlite_storage import SQLiteDatabase, SQLiteStorage
+from .pool import MachinePool
+from .sync_scheduler import SyncScheduler
+from .timers import TimerWheel, SessionTimers
+from .dispatcher import Dispatcher
+from .sharding import ShardedPool
+from .graph import analyze_script
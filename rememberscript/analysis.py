@@ -0,0 +1,174 @@
+"""
+Static analysis of the code blocks in triggers and actions
+"""
+import re
+import ast
+import math
+import builtins
+from functools import lru_cache
+from typing import FrozenSet, Iterable, NamedTuple, Union
+from .strings import CompiledString, Snippet, block_names
+
+# Nodes that may run arbitrary code, and could therefore change the weight
+# through _storage or a matching function
+_UNSAFE_NODES = (ast.Call, ast.Await, ast.Yield, ast.YieldFrom, ast.Lambda,
+                 ast.NamedExpr, ast.Import, ast.ImportFrom, ast.Global,
+                 ast.Nonlocal, ast.FunctionDef, ast.AsyncFunctionDef,
+                 ast.ClassDef)
+
+
+def _is_unsafe(tree: ast.AST) -> bool:
+    for node in ast.walk(tree):
+        if isinstance(node, _UNSAFE_NODES):
+            return True
+        # Assignments to attributes or items may run arbitrary code
+        if (isinstance(node, (ast.Attribute, ast.Subscript)) and
+                not isinstance(node.ctx, ast.Load)):
+            return True
+    return False
+
+
+def _number(node: ast.AST) -> Union[float, None]:
+    """Returns the value of a numeric literal, e.g. 2, 0.5 or -1"""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _number(node.operand)
+        if value is None:
+            return None
+        return -value if isinstance(node.op, ast.USub) else value
+    if (isinstance(node, ast.Constant) and isinstance(node.value, (int, float))):
+        return float(node.value)
+    return None
+
+
+# Expressions whose value is never a function, e.g. literals and comparisons
+_UNCALLABLE_NODES = (ast.Constant, ast.JoinedStr, ast.Compare, ast.List, ast.Tuple,
+                     ast.Set, ast.Dict, ast.ListComp, ast.SetComp, ast.DictComp,
+                     ast.GeneratorExp)
+
+
+def _is_uncallable(node: ast.AST) -> bool:
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not)
+    return isinstance(node, _UNCALLABLE_NODES)
+
+
+def weight_bound(trigger: CompiledString) -> float:
+    """Returns an upper bound on the weight a trigger can have when it matches
+
+    This is 1.0 (the default weight) unless the trigger sets the weight, in
+    which case it is the literal in the last top level '[[weight = x]]'.
+    If the weight could be set in any other way, e.g. by a function call or
+    a {{ }} block that could evaluate to a matching function, the bound is
+    infinite.
+    """
+    for part in trigger.parts:
+        if isinstance(part, str):
+            # A named group would be added to storage as weight
+            if '(?P<weight>' in part:
+                return math.inf
+            continue
+        expression = ast.parse(part.source.strip(), mode='eval')
+        # Anything but a value that can't be callable, e.g. a name, attribute
+        # or item, could evaluate to a matching function, which gets storage
+        if _is_unsafe(expression) or not _is_uncallable(expression.body):
+            return math.inf
+
+    bound = 1.0
+    for ex in trigger.execs:
+        module = ast.parse(ex.source.strip(), mode='exec')
+        if _is_unsafe(module):
+            return math.inf
+
+        top_level = set()
+        for stmt in module.body:
+            if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+                    isinstance(stmt.targets[0], ast.Name) and
+                    stmt.targets[0].id == 'weight'):
+                value = _number(stmt.value)
+                if value is None:
+                    return math.inf
+                bound = value
+                top_level.add(stmt.targets[0])
+
+        # Any other assignment to weight, e.g. in an if block
+        for node in ast.walk(module):
+            if (isinstance(node, ast.Name) and node.id == 'weight' and
+                    not isinstance(node.ctx, ast.Load) and node not in top_level):
+                return math.inf
+    return bound
+
+
+def always_weight(trigger: CompiledString) -> Union[float, None]:
+    """Returns the weight of a trigger that matches every message, e.g.
+    '{{True}}' or the default trigger of transitions without '?', or None
+    if the trigger may not match or its weight isn't known"""
+    snippets = [part for part in trigger.parts if not isinstance(part, str) or part != '']
+    if len(snippets) != 1 or not isinstance(snippets[0], Snippet):
+        return None
+    body = ast.parse(snippets[0].source.strip(), mode='eval').body
+    if not (isinstance(body, ast.Constant) and body.value is True):
+        return None
+    bound = weight_bound(trigger)
+    return bound if bound != math.inf else None
+
+
+# Storage keys set by RememberMachine itself rather than by scripts
+MACHINE_NAMES = frozenset(['_storage', 'msg', 'weight'])
+BUILTIN_NAMES = frozenset(dir(builtins))
+
+_NAMED_GROUP_RE = re.compile(r'\(\?P<(\w+)>')
+
+
+class NameUsage(NamedTuple):
+    """The storage keys that code blocks read and write
+
+    reads -- names that are loaded, including builtins used by the code
+    writes -- names that are assigned, deleted, imported or defined, and for
+              triggers the match0 ... matchN and named group variables
+
+    Note: code can also read and write other keys, e.g. through _storage
+    """
+    reads: FrozenSet[str]
+    writes: FrozenSet[str]
+
+    def __or__(self, other: 'NameUsage') -> 'NameUsage':
+        return NameUsage(self.reads | other.reads, self.writes | other.writes)
+
+
+NO_NAMES = NameUsage(frozenset(), frozenset())
+
+
+@lru_cache(maxsize=None)
+def code_names(source: str, mode: str) -> NameUsage:
+    """Returns the names used by a single code block, mode is 'exec' for
+    [[ ]] and 'eval' for {{ }} blocks"""
+    reads, writes = block_names(ast.parse(source.strip(), mode=mode))
+    return NameUsage(frozenset(reads), frozenset(writes))
+
+
+def _trigger_writes(trigger: CompiledString) -> Iterable[str]:
+    """Returns the match variables a trigger could add to storage. Every
+    {{ }} block could be a matching function, which adds a group"""
+    evals = sum(1 for part in trigger.parts if not isinstance(part, str))
+    regex = ''.join(part for part in trigger.parts if isinstance(part, str))
+    try:
+        compiled = re.compile(regex)
+        groups, named = compiled.groups, list(compiled.groupindex)
+    except re.error:
+        # Groups split by {{ }} blocks, count the opening parentheses
+        groups, named = regex.count('('), _NAMED_GROUP_RE.findall(regex)
+    return (['match%i' % i for i in range(groups + evals)] +
+            ['call%i' % i for i in range(evals)] + named)
+
+
+def string_names(string: CompiledString, trigger: bool=False) -> NameUsage:
+    """Returns the names used by the code blocks of a trigger or action"""
+    usage = NO_NAMES
+    for ex in string.execs:
+        usage |= code_names(ex.source, 'exec')
+    for part in string.parts:
+        if not isinstance(part, str):
+            usage |= code_names(part.source, 'eval')
+    if trigger:
+        usage |= NameUsage(frozenset(), frozenset(_trigger_writes(string)))
+    return usage
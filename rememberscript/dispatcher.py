@@ -0,0 +1,90 @@
+"""
+Per-session mailboxes, so that the messages of a session are processed
+strictly one after the other while different sessions run concurrently
+"""
+import time
+import asyncio
+from typing import AsyncIterator, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar('T')
+
+
+class SessionStats:
+    """Mailbox metrics of a session
+
+    depth -- number of messages queued or being processed
+    processed -- number of messages that have been processed
+    wait_time, max_wait_time -- total and max time messages waited for
+                                their turn, in seconds
+    noreply_hops, max_noreply_chain -- total and max number of noreply
+                                       states messages went through, kept
+                                       by MachinePool
+    """
+    __slots__ = ('depth', 'processed', 'wait_time', 'max_wait_time',
+                 'noreply_hops', 'max_noreply_chain')
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.processed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.noreply_hops = 0
+        self.max_noreply_chain = 0
+
+    def __repr__(self) -> str:
+        return ('SessionStats(depth=%i, processed=%i, wait_time=%.6f, max_wait_time=%.6f, '
+                'noreply_hops=%i, max_noreply_chain=%i)' % (
+                    self.depth, self.processed, self.wait_time, self.max_wait_time,
+                    self.noreply_hops, self.max_noreply_chain))
+
+
+class Dispatcher:
+    """Runs the work of each session in arrival order, one at a time, using
+    a FIFO lock per session as its mailbox. Mailboxes only exist while a
+    session has queued work, the stats are kept per session id until
+    discarded."""
+    def __init__(self) -> None:
+        self._mailboxes: Dict[Hashable, asyncio.Lock] = {}
+        self._stats: Dict[Hashable, SessionStats] = {}
+
+    def stats(self, session_id: Hashable) -> SessionStats:
+        """The stats of a session, empty ones if it has none"""
+        stats = self._stats.get(session_id, None)
+        return stats if stats is not None else SessionStats()
+
+    def discard(self, session_id: Hashable) -> None:
+        """Drops the stats of a session, unless it has queued work"""
+        stats = self._stats.get(session_id, None)
+        if stats is not None and stats.depth == 0:
+            del self._stats[session_id]
+
+    @property
+    def depth(self) -> int:
+        """Number of messages queued or being processed in all sessions"""
+        return sum(stats.depth for stats in self._stats.values())
+
+    async def serialize(self, session_id: Hashable,
+                        work: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Waits until the earlier work of the session is done, then yields
+        from work(). Note: the next work of the session only starts once this
+        iterator is exhausted or closed, so serializing more work of the same
+        session while iterating deadlocks"""
+        stats = self._stats.setdefault(session_id, SessionStats())
+        mailbox = self._mailboxes.get(session_id, None)
+        if mailbox is None:
+            mailbox = self._mailboxes[session_id] = asyncio.Lock()
+
+        stats.depth += 1
+        queued = time.perf_counter()
+        try:
+            async with mailbox:
+                wait = time.perf_counter() - queued
+                stats.wait_time += wait
+                stats.max_wait_time = max(stats.max_wait_time, wait)
+                async for item in work():
+                    yield item
+                stats.processed += 1
+        finally:
+            stats.depth -= 1
+            if stats.depth == 0:
+                del self._mailboxes[session_id]
@@ -0,0 +1,287 @@
+"""
+Analysis of the state graph of a compiled script
+
+The nodes are the states, as (story name, position), with an edge to every
+state a message can lead to: the '=>' of local transitions (including the
+next/prev/loopback keywords), the init states of stories with global
+triggers, the next state when no trigger matches, and for 'return' the
+states that entered the story (or their 'return=>').
+"""
+import sys
+import math
+import asyncio
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Set, Tuple
+from .analysis import always_weight
+from .prefilter import TriggerPrefilter, is_static
+from .script import CompiledScript, CompiledState, KEYWORDS
+from .script import load_scripts_dir, validate_script, compile_script
+
+Node = Tuple[str, int]
+Graph = Dict[Node, FrozenSet[Node]]
+
+
+def _resolve(script: CompiledScript, node: Node, target: str) -> List[Node]:
+    """Returns the state that RememberMachine._set_state(target) goes to
+    from node, if any. 'return' depends on the story stack and isn't resolved"""
+    story = script.stories[node[0]]
+    position = node[1]
+    if target == 'next':
+        return [(story.name, position + 1)] if position + 1 < len(story.states) else []
+    if target == 'prev':
+        return [(story.name, (position - 1) % len(story.states))]
+    if target == 'loopback':
+        return [node]
+    if target in KEYWORDS:
+        return []
+    if target in story.state_index:
+        return [(story.name, story.state_index[target])]
+    if target in script.stories:
+        return [(target, 0)]
+    return []
+
+
+def _global_weight(script: CompiledScript) -> Optional[float]:
+    """The weight of the heaviest global trigger that matches every message"""
+    weights = [always_weight(trigger) for trigger, _ in script.global_triggers]
+    return max((weight for weight in weights if weight is not None), default=None)
+
+
+def _moves(script: CompiledScript, state: CompiledState,
+           global_weight: Optional[float]) -> Iterator[Tuple[str, Optional[str]]]:
+    """Yields the (to, return_to) of every transition a state can take"""
+    always = [always_weight(trigger) for trigger, _ in state.triggers] + [global_weight]
+    dead = _dead_triggers(state, global_weight)
+    for i, (_, transition) in enumerate(state.triggers):
+        if i not in dead:
+            yield transition.to, transition.return_to
+    for _, story_name in script.global_triggers:
+        yield story_name, state.return_to
+    # The default transition when no trigger matches (i.e. has weight > -1)
+    if not any(weight is not None and weight > -1 for weight in always):
+        yield 'next', None
+
+
+# For each state with a 'return', the (caller, state returned to) pairs
+Returns = Dict[Node, Set[Tuple[Node, Node]]]
+
+
+def _edges(script: CompiledScript) -> Tuple[Dict[Node, Set[Node]], Returns]:
+    """Returns the edges of all transitions except 'return', and those of
+    'return' along with the state that entered the story"""
+    global_weight = _global_weight(script)
+    moves: Dict[Node, List[Tuple[str, Optional[str]]]] = {}
+    # The states that enter a story and their return_to, by story name
+    callers: Dict[str, Set[Tuple[Node, Optional[str]]]] = {}
+    for story in script.stories.values():
+        for state in story.states:
+            node = (story.name, state.position)
+            moves[node] = list(_moves(script, state, global_weight))
+            for to, return_to in moves[node]:
+                if (to not in KEYWORDS and to not in story.state_index and
+                        to in script.stories):
+                    callers.setdefault(to, set()).add((node, return_to))
+
+    edges: Dict[Node, Set[Node]] = {}
+    returns: Returns = {}
+    for node, targets in moves.items():
+        edges[node] = set()
+        for to, _ in targets:
+            if to != 'return':
+                edges[node].update(_resolve(script, node, to))
+                continue
+            for caller, return_to in callers.get(node[0], ()):
+                for target in (_resolve(script, caller, return_to) if return_to else [caller]):
+                    returns.setdefault(node, set()).add((caller, target))
+    return edges, returns
+
+
+def build_graph(script: CompiledScript) -> Graph:
+    """Returns the states each state can go to when processing a message"""
+    edges, returns = _edges(script)
+    return {node: frozenset(targets | {target for _, target in returns.get(node, ())})
+            for node, targets in edges.items()}
+
+
+def unreachable_states(script: CompiledScript) -> List[Node]:
+    """Returns the states that can't be reached from the init state of the
+    init story, in script order. Returning from a story only counts for
+    the states that entered it."""
+    edges, returns = _edges(script)
+    seen: Set[Node] = set()
+    # Return targets of reached states, waiting for their caller to be reached
+    pending: Dict[Node, Set[Node]] = {}
+    stack = [('init', 0)]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        stack.extend(edges[node])
+        stack.extend(pending.pop(node, ()))
+        for caller, target in returns.get(node, ()):
+            if caller in seen:
+                stack.append(target)
+            else:
+                pending.setdefault(caller, set()).add(target)
+    return [node for node in edges if node not in seen]
+
+
+def _components(graph: Graph) -> List[List[Node]]:
+    """Returns the strongly connected components of a graph (Tarjan's
+    algorithm, without recursion)"""
+    index: Dict[Node, int] = {}
+    low: Dict[Node, int] = {}
+    stack: List[Node] = []
+    on_stack: Set[Node] = set()
+    components = []
+    for root in graph:
+        if root in index:
+            continue
+        work = [(root, iter(graph[root]))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        while len(work) > 0:
+            node, edges = work[-1]
+            for other in edges:
+                if other not in index:
+                    index[other] = low[other] = len(index)
+                    stack.append(other)
+                    on_stack.add(other)
+                    work.append((other, iter(graph[other])))
+                    break
+                if other in on_stack:
+                    low[node] = min(low[node], index[other])
+            else:
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        other = stack.pop()
+                        on_stack.discard(other)
+                        component.append(other)
+                        if other == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def noreply_cycles(script: CompiledScript, graph: Optional[Graph]=None) -> List[List[Node]]:
+    """Returns the groups of noreply states that can go to each other in a
+    cycle. Since a noreply state processes '' right after it's entered, such
+    a cycle can keep a reply going forever"""
+    graph = build_graph(script) if graph is None else graph
+    order = {node: i for i, node in enumerate(graph)}
+    noreply = {node for node in graph
+               if script.stories[node[0]].states[node[1]].noreply}
+    subgraph = {node: frozenset(graph[node] & noreply) for node in graph if node in noreply}
+    cycles = [sorted(component, key=order.__getitem__)
+              for component in _components(subgraph)
+              if len(component) > 1 or component[0] in subgraph[component[0]]]
+    return sorted(cycles, key=lambda cycle: order[cycle[0]])
+
+
+def _dead_triggers(state: CompiledState, global_weight: Optional[float]) -> Tuple[int, ...]:
+    triggers = [trigger for trigger, _ in state.triggers]
+    weights = [always_weight(trigger) for trigger in triggers]
+    bounds = state.prefilter.bounds
+    dead = []
+    for j, trigger in enumerate(triggers):
+        # Global triggers lose ties against local ones
+        overridden = global_weight is not None and global_weight > bounds[j]
+        for i, other in enumerate(triggers):
+            if overridden:
+                break
+            weight = weights[i]
+            if i < j:
+                # Earlier triggers win ties, and a static trigger matches the
+                # same messages with the same weight as an identical one
+                overridden = ((weight is not None and weight >= bounds[j]) or
+                              (is_static(other) and other.source == trigger.source and
+                               bounds[i] != math.inf))
+            elif i > j:
+                overridden = weight is not None and weight > bounds[j]
+        if overridden:
+            dead.append(j)
+    return tuple(dead)
+
+
+def dead_triggers(script: CompiledScript) -> Dict[Node, Tuple[int, ...]]:
+    """Returns the indices (into CompiledState.triggers) of the local triggers
+    that can never be the winning trigger, because an earlier or heavier
+    trigger always matches whenever they do, by state"""
+    global_weight = _global_weight(script)
+    dead = {}
+    for story in script.stories.values():
+        for state in story.states:
+            indices = _dead_triggers(state, global_weight)
+            if len(indices) > 0:
+                dead[(story.name, state.position)] = indices
+    return dead
+
+
+def prune_triggers(script: CompiledScript) -> CompiledScript:
+    """Returns the script without its dead triggers, see dead_triggers.
+    The replies are the same, except that matching functions in the dead
+    triggers are no longer called"""
+    dead = dead_triggers(script)
+    stories = {}
+    for name, story in script.stories.items():
+        states = list(story.states)
+        for i, state in enumerate(states):
+            indices = dead.get((name, state.position), ())
+            if len(indices) == 0:
+                continue
+            triggers = tuple(trigger for j, trigger in enumerate(state.triggers)
+                             if j not in indices)
+            # names are left as they are, a superset is fine for prefetching
+            states[i] = state._replace(triggers=triggers, prefilter=TriggerPrefilter(
+                [trigger for trigger, _ in triggers]))
+        changed = any(state is not old for state, old in zip(states, story.states))
+        stories[name] = story._replace(states=tuple(states)) if changed else story
+    return script._replace(stories=MappingProxyType(stories))
+
+
+class GraphReport(NamedTuple):
+    """The problems found in the state graph of a script, see analyze_script"""
+    unreachable: List[Node]
+    noreply_cycles: List[List[Node]]
+    dead_triggers: Dict[Node, Tuple[int, ...]]
+
+
+def analyze_script(script: CompiledScript) -> GraphReport:
+    return GraphReport(unreachable_states(script), noreply_cycles(script),
+                       dead_triggers(script))
+
+
+def _state_label(script: CompiledScript, node: Node) -> str:
+    name = script.stories[node[0]].states[node[1]].name
+    return '%s/%s' % (node[0], name if name is not None else node[1])
+
+
+def main(path: str) -> int:
+    """Prints the report of a scripts dir, returns the number of problems"""
+    storage: dict = {}
+    raw = load_scripts_dir(path, storage)
+    asyncio.run(validate_script(raw))
+    script = compile_script(raw)
+    report = analyze_script(script)
+    for node in report.unreachable:
+        print('unreachable state: %s' % _state_label(script, node))
+    for cycle in report.noreply_cycles:
+        print('noreply cycle: %s' % ' -> '.join(_state_label(script, node) for node in cycle))
+    for node, indices in report.dead_triggers.items():
+        state = script.stories[node[0]].states[node[1]]
+        for i in indices:
+            print('dead trigger in %s: %s' % (_state_label(script, node),
+                                              state.triggers[i][0].source))
+    return (len(report.unreachable) + len(report.noreply_cycles) +
+            sum(len(indices) for indices in report.dead_triggers.values()))
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main(sys.argv[1]) > 0 else 0)
@@ -1,41 +1,96 @@
 import json
+import time
+import heapq
+import asyncio
+import logging
 import traceback
-from copy import deepcopy
+from itertools import groupby
+from concurrent.futures import Executor
 from types import FunctionType
-from typing import List, Any, Tuple, AsyncIterator, Union
-from .strings import process_action, match_trigger
-from .storage import StorageType
-from .misc import get_list
-from .script import ScriptType, StateType, TransitionType, StoryType
-from .script import (TRIGGER, ENTER_ACTION, EXIT_ACTION, ACTION, STATE_NAME,
-                    TRANSITIONS, RETURN_TO, NOREPLY, EXTRA, TO)
-
-Transition = Tuple[str, List[str], Union[str, None], dict]
-Triggers = List[Tuple[str, Transition]]
-StackTupleType = Tuple[StoryType, StateType, str]
-
-def _make_msg(msg: Union[str, dict], extra: dict={}) -> str:
-    msg = deepcopy(msg)
-    if isinstance(msg, str) or not isinstance(msg, dict):
-        msg = {'content': str(msg)}
-    msg.update(extra.items())
-    return json.dumps(msg)
+from typing import List, Any, FrozenSet, Tuple, AsyncIterator, Iterator, Optional, Union
+from .strings import process_action, match_trigger, CompiledString
+from .storage import StorageType, ScratchStorage
+from .messages import Message, Encoder, Encoded, encode_all
+from .script import ScriptType, ActionType, compile_script
+from .script import CompiledScript, CompiledStory, CompiledState, CompiledTransition
+
+Transition = CompiledTransition
+Candidate = Tuple[float, int, CompiledString, Transition]
+# (story name, state position, return_to) of a story we can return to
+StackTupleType = Tuple[Union[str, None], int, Union[str, None]]
+# (story name, state position, return_to, stack), see RememberMachine.position
+PositionType = Tuple[Union[str, None], int, Union[str, None], Tuple[StackTupleType, ...]]
+
+# Version of the format written by RememberMachine.snapshot, snapshots of
+# other versions can't be restored
+SNAPSHOT_VERSION = 2
+
+logger = logging.getLogger('rememberscript')
+
+
+def remap_position(old_script: CompiledScript, script: CompiledScript,
+                   story_name: str, position: int) -> Optional[int]:
+    """Returns the position in script of a state of old_script, found by
+    story and state name (or by position if its story didn't change), or
+    None if it no longer exists"""
+    story = script.stories.get(story_name, None)
+    if story is None:
+        return None
+    old_story = old_script.stories[story_name]
+    if story.states is old_story.states or story.source is old_story.source:
+        return position
+    name = old_story.states[position].name
+    return story.state_index.get(name, None) if name is not None else None
 
 
 class RememberMachine:
     """A finite state machine (FSM) that is initialized with a script,
     receives messages and yields replies. This class is build using
-    concurrent coroutines for use with asyncio. """
-    def __init__(self, script: ScriptType, storage: StorageType=None) -> None:
-        self._script = script
-        self._storage = storage or {}
+    concurrent coroutines for use with asyncio.
+
+    script -- a loaded script, or a script already run through compile_script
+    concurrency -- if set, evaluate triggers concurrently, with at most this
+                   many evaluations at a time (useful with async matching
+                   functions), otherwise evaluate them one by one
+    executor -- if set, run the trigger prefilters (the regex matching of
+                all static triggers) in this executor instead of on the
+                event loop
+    max_noreply -- if set, the most noreply states a single message can go
+                   through, a longer chain (e.g. a cycle of noreply states)
+                   stops in the state it reached. No limit by default, see
+                   graph.noreply_cycles to find the cycles
+
+    Note: a machine processes one message at a time, use a MachinePool (or a
+    Dispatcher) when messages can arrive concurrently
+    """
+    def __init__(self, script: Union[ScriptType, CompiledScript],
+                 storage: Optional[StorageType]=None, concurrency: Optional[int]=None,
+                 executor: Optional[Executor]=None, max_noreply: Optional[int]=None) -> None:
+        if not isinstance(script, CompiledScript):
+            script = compile_script(script)
+        self._script: CompiledScript = script
+        # Note: an empty storage is falsy, so compare with None
+        self._storage = storage if storage is not None else {}
+        self._concurrency = concurrency
+        self._executor = executor
+        self._max_noreply = max_noreply
+        # Number of noreply states the last message went through
+        self.noreply_chain = 0
         # Add storage itself as a private local variable, so it's accessible
-        storage['_storage'] = storage
-        self.curr_story: StoryType = []
-        self.curr_state: Union[StateType, None] = None
+        self._storage['_storage'] = self._storage
+        self.curr_story: Union[CompiledStory, None] = None
+        # Position of the current state in curr_story
+        self.curr_position = -1
         self.return_to: Union[str, None] = None
         self.story_state_stack: List[StackTupleType] = []
 
+    def _start_over(self) -> None:
+        self.curr_story = None
+        self.curr_position = -1
+        self.return_to = None
+        self.story_state_stack = []
+        self.init()
+
     def init(self):
         """Sets the current state to the init state
         Note: one never enters into the init state, we just are in it,
@@ -43,7 +98,121 @@ class RememberMachine:
         self._set_state('init')
         assert self.curr_state is not None
 
-    async def reply(self, msg: str) -> AsyncIterator[str]:
+    @property
+    def curr_state(self) -> Union[CompiledState, None]:
+        if self.curr_story is None or self.curr_position < 0:
+            return None
+        return self.curr_story.states[self.curr_position]
+
+    @property
+    def position(self) -> PositionType:
+        """The position of the machine in the script as a tuple of strings
+        and ints, i.e. everything needed to continue a conversation besides
+        the storage"""
+        return (self.curr_story.name if self.curr_story is not None else None,
+                self.curr_position, self.return_to, tuple(self.story_state_stack))
+
+    @position.setter
+    def position(self, position: PositionType) -> None:
+        story_name, curr_position, return_to, stack = position
+        if story_name is not None and story_name not in self._script.stories:
+            raise ValueError('No such story: %s' % story_name)
+        self.curr_story = (self._script.stories[story_name]
+                           if story_name is not None else None)
+        self.curr_position = curr_position
+        self.return_to = return_to
+        self.story_state_stack = list(stack)
+
+    def _state_ref(self, story_name: Union[str, None], position: int) -> Union[str, int]:
+        """The name of a state if it identifies the state, else its position"""
+        if story_name is None:
+            return position
+        story = self._script.stories[story_name]
+        name = story.states[position].name
+        return name if name is not None and story.state_index[name] == position else position
+
+    def _find_state(self, story_name: Union[str, None],
+                    state: Union[str, int]) -> Union[int, None]:
+        """Returns the position of a state given by _state_ref, or None if
+        the story or state doesn't exist in the script"""
+        if story_name is None:
+            return state if isinstance(state, int) else None
+        story = self._script.stories.get(story_name, None)
+        if story is None:
+            return None
+        if isinstance(state, str):
+            return story.state_index.get(state, None)
+        return state if 0 <= state < len(story.states) else None
+
+    def snapshot(self) -> bytes:
+        """Encodes the position of the machine as compact, versioned json with
+        stories and states given by name (states without a unique name by
+        position), so that it can be restored after the script changed, see
+        restore()"""
+        story_name, curr_position, return_to, stack = self.position
+        data = [SNAPSHOT_VERSION, story_name, self._state_ref(story_name, curr_position),
+                return_to, [[name, self._state_ref(name, position), ret]
+                            for name, position, ret in stack]]
+        return json.dumps(data, separators=(',', ':')).encode('ascii')
+
+    def restore(self, snapshot: Union[bytes, str]) -> None:
+        """Restores a position encoded by snapshot(). States are found again
+        by name like in reload(): if the current state no longer exists the
+        machine starts over in the init state, states in the stack go to the
+        init state of their story"""
+        try:
+            version, story, state, return_to, stack = json.loads(snapshot)
+        except ValueError:
+            raise ValueError('Invalid snapshot: %r' % snapshot)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: %s' % version)
+
+        restored = []
+        for name, ref, ret in stack:
+            if name is None or name in self._script.stories:
+                position = self._find_state(name, ref)
+                restored.append((name, position if position is not None else 0, ret))
+
+        position = self._find_state(story, state)
+        if position is None:
+            self._start_over()
+            return
+        self.position = (story, position, return_to, tuple(restored))
+
+    def reload(self, script: CompiledScript) -> None:
+        """Switches to a new version of the script. The current state, and
+        the states in the story stack, are found again by story and state
+        name (or by position if their story didn't change). If the current
+        state no longer exists the machine starts over in the init state,
+        states in the stack go to the init state of their story."""
+        old_script, self._script = self._script, script
+
+        def remap(story_name: Union[str, None], position: int) -> Union[int, None]:
+            if story_name is None:
+                return position
+            return remap_position(old_script, script, story_name, position)
+
+        stack = []
+        for story_name, position, return_to in self.story_state_stack:
+            if story_name is None or story_name in script.stories:
+                new_position = remap(story_name, position)
+                stack.append((story_name, new_position if new_position is not None else 0,
+                              return_to))
+
+        story_name = self.curr_story.name if self.curr_story is not None else None
+        curr_position = remap(story_name, self.curr_position)
+        if curr_position is None:
+            self._start_over()
+            return
+        self.position = (story_name, curr_position, self.return_to, tuple(stack))
+
+    async def reply(self, msg: str, dumps: Encoder=json.dumps) -> AsyncIterator[Encoded]:
+        """Processes a message and yields the replies encoded with dumps,
+        see replies()"""
+        async for m in encode_all(self.replies(msg), dumps):
+            yield m
+
+    async def replies(self, msg: str) -> AsyncIterator[Message]:
         """Processes a message and yields any number of replies in this way:
         1. Run any =exit actions in the current state
         2. Evaluates all global and local triggers and finds the highest
@@ -53,107 +222,205 @@ class RememberMachine:
         5. Run any =enter actions on the new state
 
         Note: this is an async generator coroutine"""
-        self._storage['msg'] = msg
+        async for m in self._replies(msg, time.perf_counter()):
+            yield m
+
+    async def _replies(self, msg: str, received: float) -> AsyncIterator[Message]:
+        # Entering a noreply state processes '' right away, which is done in
+        # this loop rather than recursively, so long chains stay cheap
+        self.noreply_chain = 0
+        while True:
+            self._storage['msg'] = msg
+            state = self.curr_state
+            assert state is not None, 'The machine has to be initialized with init()'
+            await self._prefetch(state.names.reads | self._script.global_names.reads)
 
-        for action in get_list(self.curr_state, EXIT_ACTION):
-            extra = self.curr_state.get(EXTRA, {})
-            async for m in self._evaluate_action(action, extra):
-                yield m
+            for action in state.exit_actions:
+                async for m in self._evaluate_action(action, state.extra, received):
+                    yield m
 
-        next_state, trans_actions, self.return_to, extra = await self._get_max_transition(msg)
-        for action in trans_actions:
-            async for m in self._evaluate_action(action, extra):
-                yield m
+            next_state, trans_actions, self.return_to, extra = await self._get_max_transition(msg)
+            for action in trans_actions:
+                async for m in self._evaluate_action(action, extra, received):
+                    yield m
 
-        self._set_state(next_state)
-        for action in get_list(self.curr_state, ENTER_ACTION):
-            extra = self.curr_state.get(EXTRA, {})
-            async for m in self._evaluate_action(action, extra):
-                yield m
+            self._set_state(next_state)
+            state = self.curr_state
+            assert state is not None
+            await self._prefetch(state.names.reads)
+            for action in state.enter_actions:
+                async for m in self._evaluate_action(action, state.extra, received):
+                    yield m
 
-        if self.curr_state.get(NOREPLY, False):
-            async for m in self.reply(''):
-                yield m
+            if not state.noreply:
+                return
+            if self._max_noreply is not None and self.noreply_chain >= self._max_noreply:
+                story_name = self.curr_story.name if self.curr_story is not None else None
+                logger.error('Stopped a chain of %i noreply states in state %s of story %s' % (
+                    self.noreply_chain, state.name, story_name))
+                return
+            self.noreply_chain += 1
+            msg = ''
 
     def _set_state(self, name_or_story: str) -> None:
         # Check for reserved keywords
         if name_or_story == 'next':
             # go to next state in script
-            self.curr_state = self.curr_story[self.curr_story.index(self.curr_state)+1]
+            assert self.curr_story is not None
+            if self.curr_position + 1 >= len(self.curr_story.states):
+                raise IndexError('No next state after %s' % (
+                    self.curr_story.states[self.curr_position].name))
+            self.curr_position += 1
             return
         if name_or_story == 'prev':
-            # go to prev state in script
-            self.curr_state = self.curr_story[self.curr_story.index(self.curr_state)-1]
+            # go to prev state in script, wrapping around to the last one
+            assert self.curr_story is not None
+            self.curr_position = (self.curr_position - 1) % len(self.curr_story.states)
             return
         if name_or_story == 'loopback':
             # loop back to the same state in script
             return
         if name_or_story == 'return':
             # return to previous story in the stack
-            story, state, return_to = self.story_state_stack.pop()
+            story_name, position, return_to = self.story_state_stack.pop()
+            self.curr_story = (self._script.stories[story_name]
+                               if story_name is not None else None)
+            self.curr_position = position
             if return_to:
-                self.curr_story, self.curr_state = story, state
                 self._set_state(return_to)
-            else:
-                self.curr_story, self.curr_state = story, state
             return
 
         # First check states in the local story
-        for state in self.curr_story:
-            if state.get(STATE_NAME, None) == name_or_story:
-                self.curr_state = state
-                return
+        if self.curr_story is not None and name_or_story in self.curr_story.state_index:
+            self.curr_position = self.curr_story.state_index[name_or_story]
+            return
 
         # Then check stories in the script
-        if name_or_story in self._script:
-            self.story_state_stack.append((self.curr_story, self.curr_state,
-                                           self.return_to))
-            self.curr_story = self._script[name_or_story]
+        story = self._script.stories.get(name_or_story, None)
+        if story is not None:
+            self.story_state_stack.append((
+                self.curr_story.name if self.curr_story is not None else None,
+                self.curr_position, self.return_to))
+            self.curr_story = story
             # Return the init state of the new story
             self._set_state('init')
             return
         else:
             raise ValueError('No such state or story: %s' % name_or_story)
 
+    async def _prefetch(self, names: FrozenSet[str]) -> None:
+        """Lets a lazily loaded storage decode the keys a state reads up front"""
+        prefetch = getattr(self._storage, 'prefetch', None)
+        if prefetch is not None:
+            await prefetch(names)
+
+    async def _candidates(self, msg: str) -> Iterator[Candidate]:
+        """Returns (bound, position, trigger, transition) for the local and
+        global triggers that pass the prefilters, by descending weight bound
+        and then by position, where local triggers come before global ones"""
+        state = self.curr_state
+        assert state is not None
+        prefilter = self._script.global_prefilter
+        if self._executor is None:
+            local_indices = state.prefilter.candidates(msg)
+            global_indices = prefilter.candidates(msg)
+        else:
+            loop = asyncio.get_event_loop()
+            local_indices, global_indices = await asyncio.gather(
+                loop.run_in_executor(self._executor, state.prefilter.candidates, msg),
+                loop.run_in_executor(self._executor, prefilter.candidates, msg))
+
+        loc = ((state.prefilter.bounds[i], i) + state.triggers[i] for i in local_indices)
+
+        def glob() -> Iterator[Candidate]:
+            # Triggers reachable from anywhere go to the init state of their story
+            for i in global_indices:
+                trigger, story_name = self._script.global_triggers[i]
+                yield (prefilter.bounds[i], len(state.triggers) + i, trigger,
+                       CompiledTransition(story_name, (), state.return_to, {}))
+
+        return heapq.merge(loc, glob(), key=lambda c: (-c[0], c[1]))
+
     async def _get_max_transition(self, msg) -> Transition:
-        """Returns triples of local and global triggers 
-        with (trigger, state_name, actions, return_to)"""
-        # Get triggers local to this state
-        # Have a default trigger with weight 0, so that any other successful
-        # trigger with weight > 0 overrides it
-        default_trigger = ["{{True}}[[weight = 0]]"]
-        default_return = self.curr_state.get(RETURN_TO, None)
-        loc: Triggers = [(trigger, (trans.get(TO, 'next'), get_list(trans, ACTION),
-                         trans.get(RETURN_TO, default_return), trans.get(EXTRA, {})))
-                         for trans in get_list(self.curr_state, TRANSITIONS)
-                         for trigger in get_list(trans, TRIGGER, default_trigger)]
-
-        # Get triggers reachable from anywhere
-        glob: Triggers = [(trigger, (story_name, [], default_return, {}))
-                          for story_name, story in self._script.items()
-                          for trigger in get_list(story[0], TRIGGER)]
+        """Returns the transition (state_name, actions, return_to, extra) of
+        the first local or global trigger with the highest weight"""
+        if self._concurrency:
+            return await self._get_max_transition_concurrent(msg)
 
         # If there are no successful local or global triggers, default to next state
-        max_transition: Transition = ('next', [], None, {})
+        max_transition: Transition = CompiledTransition('next', (), None, {})
         max_weight = -1.0
-        for trigger, transition in loc + glob:
-            weight = await self._evaluate_trigger(trigger, msg)
-            if weight > max_weight:
+        max_position = None
+        max_scratch = None
+        for bound, position, trigger, transition in await self._candidates(msg):
+            # Stop when the remaining triggers can at best tie with the max,
+            # and skip ties that would lose against an earlier trigger
+            if bound < max_weight:
+                break
+            if bound == max_weight and (max_position is None or position > max_position):
+                continue
+
+            weight, scratch = await self._evaluate_trigger(trigger, msg)
+            if weight > max_weight or (weight == max_weight and max_position is not None
+                                       and position < max_position):
                 max_transition = transition
                 max_weight = weight
+                max_position = position
+                max_scratch = scratch
+
+        # Only the winning trigger gets to write e.g. its matches to storage
+        if max_scratch is not None:
+            max_scratch.commit(exclude=('weight',))
         return max_transition
 
-    async def _evaluate_action(self, action: Union[str, dict], extra: dict) -> AsyncIterator[Union[str]]:
+    async def _get_max_transition_concurrent(self, msg) -> Transition:
+        """Same as _get_max_transition, but evaluates all triggers with the same
+        weight bound concurrently"""
+        assert self._concurrency is not None
+        semaphore = asyncio.Semaphore(self._concurrency)
+        async def evaluate(trigger):
+            async with semaphore:
+                return await self._evaluate_trigger(trigger, msg)
+
+        max_transition: Transition = CompiledTransition('next', (), None, {})
+        max_weight = -1.0
+        max_position = None
+        max_scratch = None
+        for bound, candidates in groupby(await self._candidates(msg), key=lambda c: c[0]):
+            if bound < max_weight:
+                break
+            tier = [c for c in candidates if bound > max_weight or
+                    (max_position is not None and c[1] < max_position)]
+            results = await asyncio.gather(*(evaluate(c[2]) for c in tier))
+
+            # Pick the winner in position order, as if evaluated one by one
+            for (_, position, _, transition), (weight, scratch) in zip(tier, results):
+                if weight > max_weight or (weight == max_weight and max_position is not None
+                                           and position < max_position):
+                    max_transition = transition
+                    max_weight = weight
+                    max_position = position
+                    max_scratch = scratch
+
+        # Only the winning trigger gets to write e.g. its matches to storage
+        if max_scratch is not None:
+            max_scratch.commit(exclude=('weight',))
+        return max_transition
+
+    async def _evaluate_action(self, action: ActionType, extra: dict,
+                               received: float) -> AsyncIterator[Message]:
         if isinstance(action, dict):
-            yield json.dumps(action)
+            # Structured replies in the script are sent as they are
+            yield Message(action, {}, received)
             return
         async for msg in process_action(action, self._storage):
-            yield _make_msg(msg, extra)
-
-    async def _evaluate_trigger(self, trigger: str, msg: str) -> float:
-        self._storage['weight'] = 1.0 # set default weight
-        match: bool = await match_trigger(msg, trigger, self._storage)
-        weight = self._storage['weight']
-        del self._storage['weight']
+            yield Message(msg, extra, received)
 
-        return weight if match else -1.0
+    async def _evaluate_trigger(self, trigger: CompiledString,
+                                msg: str) -> Tuple[float, ScratchStorage]:
+        """Returns the weight of the trigger, or -1 if it doesn't match, and the
+        scratch storage it wrote to"""
+        scratch = ScratchStorage(self._storage)
+        scratch['weight'] = 1.0 # set default weight
+        match: bool = await match_trigger(msg, trigger, scratch)
+        return (scratch['weight'] if match else -1.0), scratch
@@ -0,0 +1,100 @@
+"""
+Structured replies and the stages for sending them: encoding to JSON and
+buffering between a machine and a slow consumer
+"""
+import json
+import time
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, Union
+
+# An encoded reply and an encoder, e.g. json.dumps
+Encoded = Union[str, bytes]
+Encoder = Callable[[Any], Encoded]
+
+
+class Message:
+    """A reply as yielded by RememberMachine.replies, without any copies
+
+    content -- the reply, a str, or e.g. a dict for structured replies
+    extra -- the extra dict of the state or transition, shared with the
+             script, so it must not be modified
+    received -- time.perf_counter() when the message being replied to arrived
+    created -- time.perf_counter() when this reply was produced
+    """
+    __slots__ = ('content', 'extra', 'received', 'created')
+
+    def __init__(self, content: Any, extra: dict, received: float) -> None:
+        self.content = content
+        self.extra = extra
+        self.received = received
+        self.created = time.perf_counter()
+
+    @property
+    def latency(self) -> float:
+        """Seconds from receiving the message to producing this reply"""
+        return self.created - self.received
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the reply as sent by RememberMachine.reply, i.e. the content
+        (as a str unless it's a dict) with the extra entries added"""
+        if isinstance(self.content, dict):
+            if len(self.extra) == 0:
+                return self.content
+            msg = dict(self.content)
+        else:
+            msg = {'content': str(self.content)}
+        msg.update(self.extra.items())
+        return msg
+
+    def __repr__(self) -> str:
+        return 'Message(%r, %r)' % (self.content, self.extra)
+
+
+def encode(message: Message, dumps: Encoder=json.dumps) -> Encoded:
+    """Encodes a message with dumps, e.g. json.dumps or a faster encoder"""
+    return dumps(message.to_dict())
+
+
+async def encode_all(messages: AsyncIterator[Message],
+                     dumps: Encoder=json.dumps) -> AsyncIterator[Encoded]:
+    """Output stage that encodes a stream of messages"""
+    async for message in messages:
+        yield encode(message, dumps)
+
+
+class _End:
+    """Marks the end of a buffered stream, with the error that ended it"""
+    __slots__ = ('error',)
+
+    def __init__(self, error: Union[Exception, None]=None) -> None:
+        self.error = error
+
+
+async def buffered(replies: AsyncIterator[Any], maxsize: int=16) -> AsyncIterator[Any]:
+    """Runs an async iterator of replies ahead of its consumer, keeping at
+    most maxsize replies in a queue. When the consumer lags behind, e.g. a
+    slow transport, the replies are produced until the queue is full and then
+    the producer waits. Errors are raised to the consumer, and the producer is
+    cancelled if the consumer stops early."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+    async def produce():
+        try:
+            async for reply in replies:
+                await queue.put(reply)
+        except Exception as e:
+            await queue.put(_End(e))
+            return
+        await queue.put(_End())
+
+    task = asyncio.ensure_future(produce())
+    try:
+        while True:
+            reply = await queue.get()
+            if isinstance(reply, _End):
+                if reply.error is not None:
+                    raise reply.error
+                return
+            yield reply
+    finally:
+        task.cancel()
@@ -0,0 +1,422 @@
+"""
+A pool of RememberMachines, one per session, that share a single compiled
+script. Only the most recently used sessions are kept as machines, the others
+are parked as a snapshot of their position and, if persistent, with their
+storage synced and released.
+"""
+import os
+import json
+import hashlib
+import asyncio
+import inspect
+import logging
+import traceback
+from copy import deepcopy
+from functools import partial
+from concurrent.futures import Executor
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Tuple, Union
+from .machine import RememberMachine, remap_position
+from .messages import Message, Encoder, Encoded, encode_all
+from .script import ScriptType, CompiledScript, ValidatedExamples, ScriptCache
+from .script import load_scripts_dir, validate_script, compile_script
+from .storage import StorageType, _sync_var
+from .sync_scheduler import SyncScheduler
+from .dispatcher import Dispatcher
+from .timers import SessionTimers, TimerKey
+
+logger = logging.getLogger('rememberscript')
+
+SessionId = Hashable
+StorageFactory = Callable[[SessionId], StorageType]
+TimerHandler = Callable[[SessionId, AsyncIterator[Message]], Awaitable[None]]
+
+# Key of the machine snapshot in persistent storages, so that sessions
+# continue where they were after a restart
+SNAPSHOT_KEY = 'rememberscript_snapshot'
+
+
+def _dir_signature(path: str) -> List[Tuple[str, bytes]]:
+    """Returns (name, content digest) of the script files in a dir"""
+    signature = []
+    for entry in os.scandir(path):
+        if not (entry.name.endswith('.yaml') or entry.name.endswith('.py')):
+            continue
+        try:
+            with open(entry.path, 'rb') as f:
+                signature.append((entry.name, hashlib.sha1(f.read()).digest()))
+        except FileNotFoundError:
+            # Removed since it was listed
+            pass
+    return sorted(signature)
+
+
+def _py_digests(path: str, story_names: Iterable[str]) -> Dict[str, Optional[bytes]]:
+    """Returns the digest of the .py file of every story, None if it has none"""
+    digests: Dict[str, Optional[bytes]] = {}
+    for story_name in story_names:
+        try:
+            with open(os.path.join(path, story_name+'.py'), 'rb') as f:
+                digests[story_name] = hashlib.sha1(f.read()).digest()
+        except FileNotFoundError:
+            digests[story_name] = None
+    return digests
+
+
+def _load_dir(path: str, cache_path: Optional[str], cache: ScriptCache
+              ) -> Tuple[ScriptType, StorageType, Dict[str, Optional[bytes]]]:
+    """Returns the script, defaults and .py digests of a scripts dir, run in
+    an executor so that reading and parsing don't block the event loop"""
+    defaults: StorageType = {}
+    script = load_scripts_dir(path, defaults, cache_path, cache=cache)
+    return script, defaults, _py_digests(path, script)
+
+
+class _ParkedSession:
+    """What's left of a session that isn't in use"""
+    __slots__ = ('snapshot', 'storage')
+
+    def __init__(self, snapshot: bytes, storage: Union[StorageType, None]) -> None:
+        self.snapshot = snapshot
+        self.storage = storage
+
+
+class MachinePool:
+    """Routes messages to per-session machines running one shared script
+
+    script -- a loaded or compiled script, shared read-only by all sessions
+    defaults -- the storage the script was loaded with, i.e. the variables
+                and functions of the script's .py files, copied to every new
+                session's storage
+    storage_factory -- called with a session id to create its storage, e.g.
+                       a FileStorage. Storages with a sync() method are synced
+                       and released when the session is parked and recreated
+                       (and loaded) when it is used again. Without a factory,
+                       sessions get a dict that is kept while parked.
+    max_active -- number of recently used sessions kept as machines
+    concurrency -- passed on to RememberMachine
+    sync_scheduler -- if given, the storage of a session is scheduled for sync
+                      after every reply, and parking goes through it
+    timers -- SessionTimers for the states with a timer, a session doesn't
+              need to be active for its timer to fire
+    on_timer -- coroutine function called with (session id, replies) when a
+                timer fired, to send the replies. By default they're dropped
+    executor, max_noreply -- passed on to RememberMachine
+
+    The messages of a session, including timer messages, are processed one
+    after the other through a Dispatcher, see dispatcher.stats() for the
+    queue depth, wait times and noreply chains of each session until it's
+    parked. The next message of a session waits until the replies of the
+    previous one are exhausted or closed, so don't send to a session while
+    iterating over its replies.
+    """
+    def __init__(self, script: Union[ScriptType, CompiledScript],
+                 defaults: Optional[StorageType]=None,
+                 storage_factory: Optional[StorageFactory]=None,
+                 max_active: int=1024, concurrency: Optional[int]=None,
+                 sync_scheduler: Optional[SyncScheduler]=None,
+                 timers: Optional[SessionTimers]=None, on_timer: Optional[TimerHandler]=None,
+                 executor: Optional[Executor]=None, max_noreply: Optional[int]=None) -> None:
+        if not isinstance(script, CompiledScript):
+            script = compile_script(script)
+        self._script = script
+        # The digests of the .py files, to find the ones that changed on
+        # reload, known when the pool was loaded from a dir
+        self._py_digests: Dict[str, Optional[bytes]] = {}
+        # The parsed yaml files by content digest, so that reload only
+        # parses the changed ones
+        self._yaml_cache: ScriptCache = {}
+        self._reload_lock = asyncio.Lock()
+        # The transitions whose trigger examples passed, see validate_script
+        self._validated: ValidatedExamples = {}
+        self._defaults = defaults or {}
+        self._storage_factory = storage_factory
+        self._max_active = max_active
+        self._concurrency = concurrency
+        self._sync_scheduler = sync_scheduler
+        self._timers = timers
+        self._on_timer = on_timer
+        self._executor = executor
+        self._max_noreply = max_noreply
+        self.dispatcher = Dispatcher()
+        self._active: 'OrderedDict[SessionId, RememberMachine]' = OrderedDict()
+        self._parked: Dict[SessionId, _ParkedSession] = {}
+        self._busy: Dict[SessionId, int] = {}
+        self._loading: Dict[SessionId, 'asyncio.Future[RememberMachine]'] = {}
+
+    @classmethod
+    async def load(cls, path: str, **kwargs: Any) -> 'MachinePool':
+        """Loads, validates and compiles the scripts in a dir once and
+        returns a pool running them, see MachinePool for kwargs"""
+        cache: ScriptCache = {}
+        script, defaults, py_digests = await asyncio.get_event_loop().run_in_executor(
+            None, _load_dir, path, None, cache)
+        validated: ValidatedExamples = {}
+        await validate_script(script, defaults, validated=validated)
+        pool = cls(script, defaults, **kwargs)
+        pool._py_digests = py_digests
+        pool._yaml_cache = cache
+        pool._validated = validated
+        return pool
+
+    async def reload(self, path: str, cache_path: Optional[str]=None) -> List[str]:
+        """Loads the scripts in a dir again and swaps in the stories that
+        changed, validating and compiling only those. Returns the names of
+        the stories whose yaml or .py file changed and of the removed ones.
+
+        Sessions continue in the state with the same name in the new script
+        (see RememberMachine.reload), active ones on their next message, and
+        so do their timers. Functions and classes from the .py files are
+        updated in their storage. If the new script doesn't validate, the
+        old one is kept and the error is raised. Only the yaml files whose
+        content changed since the last load are parsed again."""
+        async with self._reload_lock:
+            return await self._reload(path, cache_path)
+
+    async def _reload(self, path: str, cache_path: Optional[str]) -> List[str]:
+        script, defaults, py_digests = await asyncio.get_event_loop().run_in_executor(
+            None, _load_dir, path, cache_path, self._yaml_cache)
+        stories = self._script.stories
+        changed = [name for name, states in script.items()
+                   if name not in stories or stories[name].source != states]
+        # A story whose .py file changed doesn't need compiling again
+        py_changed = [name for name in script if name not in changed and
+                      name in self._py_digests and self._py_digests[name] != py_digests[name]]
+        removed = [name for name in self._script.story_names if name not in script]
+        if len(changed) == 0 and len(removed) == 0 and py_digests == self._py_digests:
+            return []
+
+        await validate_script(script, defaults, changed, self._validated)
+        compiled = compile_script(script, self._script, changed)
+
+        # Swap without awaiting, so no message sees a partial reload
+        previous, self._script = self._script, compiled
+        self._py_digests = py_digests
+        self._defaults = defaults
+        for parked in self._parked.values():
+            machine = RememberMachine(previous, {})
+            machine.restore(parked.snapshot)
+            machine.reload(compiled)
+            parked.snapshot = machine.snapshot()
+            if parked.storage is not None:
+                self._update_functions(parked.storage)
+        if self._timers is not None:
+            self._timers.remap(partial(_remap_timer, previous, compiled))
+        return changed + py_changed + removed
+
+    async def watch(self, path: str, interval: float=1.0, cache_path: Optional[str]=None) -> None:
+        """Polls a scripts dir every interval seconds and reloads it when a
+        file's content changed, until cancelled. Failed reloads are logged"""
+        loop = asyncio.get_event_loop()
+        signature = await loop.run_in_executor(None, _dir_signature, path)
+        while True:
+            await asyncio.sleep(interval)
+            current = await loop.run_in_executor(None, _dir_signature, path)
+            if current == signature:
+                continue
+            signature = current
+            try:
+                changed = await self.reload(path, cache_path)
+                logger.info('reloaded stories: %s' % ', '.join(changed))
+            except Exception:
+                logger.error('reload failed, keeping the current script')
+                logger.error(traceback.format_exc())
+
+    def __len__(self) -> int:
+        return len(self._active) + len(self._parked)
+
+    def __contains__(self, session_id: SessionId) -> bool:
+        return session_id in self._active or session_id in self._parked
+
+    @property
+    def active_count(self) -> int:
+        """Number of sessions currently kept as machines"""
+        return len(self._active)
+
+    async def reply(self, session_id: SessionId, msg: str,
+                    dumps: Encoder=json.dumps) -> AsyncIterator[Encoded]:
+        """Processes a message in a session, creating the session if needed,
+        and yields the replies like RememberMachine.reply. Messages sent to
+        the same session before the replies are exhausted wait for them"""
+        async for m in encode_all(self.replies(session_id, msg), dumps):
+            yield m
+
+    async def replies(self, session_id: SessionId, msg: str) -> AsyncIterator[Message]:
+        """Same as reply, but yields Messages like RememberMachine.replies"""
+        async for m in self._replies(session_id, msg, None):
+            yield m
+
+    def restore_timers(self) -> None:
+        """Schedules the timers persisted in the storage of timers, e.g. after
+        a restart. The storage has to be loaded first"""
+        assert self._timers is not None, 'The pool has no timers'
+        self._timers.restore(self._fire_timer)
+
+    async def _replies(self, session_id: SessionId, msg: str,
+                       fired: Optional[TimerKey]) -> AsyncIterator[Message]:
+        # The messages of a session are processed one at a time, in order
+        work = partial(self._process, session_id, msg, fired)
+        try:
+            async for m in self.dispatcher.serialize(session_id, work):
+                yield m
+        finally:
+            if session_id not in self._active:
+                # Parked, or failed to load
+                self.dispatcher.discard(session_id)
+
+    async def _process(self, session_id: SessionId, msg: str,
+                       fired: Optional[TimerKey]) -> AsyncIterator[Message]:
+        machine = await self._get_machine(session_id)
+        if machine._script is not self._script:
+            self._reload_machine(machine)
+        if fired is not None and machine.position[:2] != fired:
+            # The session left the state before its timer's turn
+            return
+
+        self._busy[session_id] = self._busy.get(session_id, 0) + 1
+        try:
+            async for m in machine.replies(msg):
+                yield m
+        finally:
+            stats = self.dispatcher.stats(session_id)
+            stats.noreply_hops += machine.noreply_chain
+            stats.max_noreply_chain = max(stats.max_noreply_chain, machine.noreply_chain)
+            self._busy[session_id] -= 1
+            if self._busy[session_id] == 0:
+                del self._busy[session_id]
+
+        storages = [machine._storage]
+        if self._timers is not None:
+            story, state = machine.curr_story, machine.curr_state
+            assert story is not None and state is not None
+            self._timers.update(session_id, (story.name, state.position),
+                                state.timer, fired, self._fire_timer)
+            if self._timers.storage is not None:
+                storages.append(self._timers.storage)
+        if self._sync_scheduler is not None:
+            for storage in storages:
+                if hasattr(storage, 'sync'):
+                    self._sync_scheduler.schedule(storage)
+        await self._park_idle()
+
+    async def park(self, session_id: SessionId) -> None:
+        """Parks an active session, see MachinePool"""
+        machine = self._active.pop(session_id, None)
+        if machine is None:
+            return
+        self.dispatcher.discard(session_id)
+
+        if machine._script is not self._script:
+            # Snapshots are restored with the current script
+            self._reload_machine(machine)
+        storage = machine._storage
+        parked = _ParkedSession(machine.snapshot(), storage)
+        self._parked[session_id] = parked
+        if self._storage_factory is None or not hasattr(storage, 'sync'):
+            return
+
+        storage[SNAPSHOT_KEY] = parked.snapshot.decode('ascii')
+        if self._sync_scheduler is not None:
+            await self._sync_scheduler.sync(storage)
+        else:
+            await storage.sync()
+        # Release the storage, unless the session was used while syncing
+        if self._parked.get(session_id, None) is parked:
+            parked.storage = None
+
+    async def close(self) -> None:
+        """Parks all active sessions, syncing their storages"""
+        for session_id in list(self._active):
+            await self.park(session_id)
+        if self._timers is not None:
+            self._timers.stop()
+            sync = getattr(self._timers.storage, 'sync', None)
+            if sync is not None:
+                await sync()
+
+    async def _fire_timer(self, session_id: SessionId, key: TimerKey) -> None:
+        """Processes the timer message of the state at key, if the session
+        is still in it"""
+        story_name, position = key
+        story = self._script.stories.get(story_name, None)
+        timer = (story.states[position].timer
+                 if story is not None and position < len(story.states) else None)
+        if timer is None:
+            # The state changed in a reload
+            return
+        replies = self._replies(session_id, timer.msg, key)
+        if self._on_timer is not None:
+            await self._on_timer(session_id, replies)
+        else:
+            async for _ in replies:
+                pass
+
+    def _reload_machine(self, machine: RememberMachine) -> None:
+        machine.reload(self._script)
+        self._update_functions(machine._storage)
+
+    def _update_functions(self, storage: StorageType) -> None:
+        """Sets the functions, classes and modules of the .py files"""
+        for key, val in self._defaults.items():
+            if not _sync_var(key, val):
+                storage[key] = val
+
+    async def _get_machine(self, session_id: SessionId) -> RememberMachine:
+        machine = self._active.get(session_id, None)
+        if machine is None:
+            # Concurrent calls for the same session wait for the same load
+            loading = self._loading.get(session_id, None)
+            if loading is None:
+                loading = self._loading[session_id] = asyncio.ensure_future(
+                    self._load_machine(session_id))
+                loading.add_done_callback(lambda _: self._loading.pop(session_id, None))
+            machine = await asyncio.shield(loading)
+        self._active.move_to_end(session_id)
+        return machine
+
+    async def _load_machine(self, session_id: SessionId) -> RememberMachine:
+        """Activates a parked or new session"""
+        parked = self._parked.get(session_id, None)
+        storage = parked.storage if parked is not None else None
+        if storage is None:
+            storage = await self._new_storage(session_id)
+        # Only pop the parked session once it's loaded, so that it's never
+        # missing while the storage loads
+        parked = self._parked.pop(session_id, None)
+
+        machine = RememberMachine(self._script, storage, self._concurrency, self._executor,
+                                  self._max_noreply)
+        if parked is not None:
+            machine.restore(parked.snapshot)
+        elif SNAPSHOT_KEY in storage:
+            machine.restore(storage[SNAPSHOT_KEY])
+        else:
+            machine.init()
+        self._active[session_id] = machine
+        return machine
+
+    async def _new_storage(self, session_id: SessionId) -> StorageType:
+        storage = (self._storage_factory(session_id)
+                   if self._storage_factory is not None else {})
+
+        # Every session gets its own copy of the script's variables,
+        # any persisted values are loaded on top of them
+        for key, val in self._defaults.items():
+            storage[key] = deepcopy(val) if _sync_var(key, val) else val
+        load = getattr(storage, 'load', None)
+        if inspect.iscoroutinefunction(load):
+            await load()
+        return storage
+
+    async def _park_idle(self) -> None:
+        """Parks the least recently used sessions that aren't busy"""
+        idle = [session_id for session_id in self._active
+                if session_id not in self._busy]
+        for session_id in idle[:max(0, len(self._active) - self._max_active)]:
+            await self.park(session_id)
+
+
+def _remap_timer(previous: CompiledScript, script: CompiledScript,
+                 key: TimerKey) -> Optional[TimerKey]:
+    position = remap_position(previous, script, key[0], key[1])
+    return (key[0], position) if position is not None else None
@@ -0,0 +1,83 @@
+"""
+Prefiltering of triggers, matches a message against all static triggers of a
+state (or all global triggers) at once so that only the triggers that can
+possibly match need to be evaluated
+
+A trigger is static if it has no {{ }} blocks, i.e. its regex is known before
+the message arrives. Dynamic triggers always pass the prefilter.
+
+The candidates are returned in the order they should be evaluated in, highest
+weight bound first, so that evaluation can stop as soon as no remaining
+trigger can beat the best match so far.
+"""
+import re
+from typing import Dict, List, Sequence, Tuple, Pattern, Union
+from .strings import CompiledString
+from .analysis import weight_bound
+
+# Characters that make a trigger a regex rather than a literal string
+REGEX_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def is_static(trigger: CompiledString) -> bool:
+    """Whether the trigger's regex is known without evaluating anything"""
+    return all(isinstance(part, str) for part in trigger.parts)
+
+
+class TriggerPrefilter:
+    """Finds the triggers in a sequence that can match a message
+
+    Literal triggers are looked up in a dict, regex triggers without groups are
+    combined into a single alternation that rejects most messages in one pass,
+    and only regex triggers with groups are tried one by one
+    """
+    def __init__(self, triggers: Sequence[CompiledString]) -> None:
+        # Upper bound on the weight of each trigger, see weight_bound
+        self.bounds = tuple(weight_bound(trigger) for trigger in triggers)
+        self._dynamic: List[int] = []
+        self._literals: Dict[str, List[int]] = {}
+        self._plain: List[Tuple[int, Pattern]] = []
+        self._grouped: List[Tuple[int, Pattern]] = []
+        for i, trigger in enumerate(triggers):
+            if not is_static(trigger):
+                self._dynamic.append(i)
+                continue
+
+            pattern = trigger.remainder
+            if not REGEX_CHARS.intersection(pattern):
+                self._literals.setdefault(pattern, []).append(i)
+                continue
+
+            try:
+                regex = re.compile('^%s$' % pattern)
+            except re.error:
+                # Let the full evaluation report the error
+                self._dynamic.append(i)
+                continue
+            (self._grouped if regex.groups > 0 else self._plain).append((i, regex))
+
+        self._combined: Union[Pattern, None] = None
+        if len(self._plain) > 1:
+            # Every alternative is anchored like its trigger is on its own,
+            # so that a top-level '|' in a trigger keeps its meaning
+            try:
+                self._combined = re.compile('|'.join(
+                    '(?:^%s$)' % triggers[i].remainder for i, _ in self._plain))
+            except re.error:
+                pass
+
+    def candidates(self, msg: str) -> List[int]:
+        """Returns the indices of the triggers that may match msg, ordered by
+        descending weight bound and then by index"""
+        result = list(self._dynamic)
+        result.extend(self._literals.get(msg, ()))
+        if msg.endswith('\n'):
+            # '$' also matches right before a trailing newline
+            result.extend(self._literals.get(msg[:-1], ()))
+
+        if self._combined is None or self._combined.match(msg):
+            result.extend(i for i, regex in self._plain if regex.match(msg))
+        result.extend(i for i, regex in self._grouped if regex.match(msg))
+
+        result.sort(key=lambda i: (-self.bounds[i], i))
+        return result
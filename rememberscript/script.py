@@ -8,13 +8,20 @@ or not flexible enough to represent the schema needed
 """
 import os
 import glob
+import json
 import yaml
+import pickle
+import hashlib
 import asyncio
 import logging
 import traceback
-from typing import Dict, List, Any
-from .storage import StorageType
-from .strings import execute_string, match_trigger
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Any, FrozenSet, Iterable, Iterator, Tuple, Union, Mapping, NamedTuple, Optional
+from .storage import StorageType, atomic_write
+from .strings import execute_string, match_trigger, compile_string, CompiledString
+from .prefilter import TriggerPrefilter
+from .analysis import NameUsage, NO_NAMES, MACHINE_NAMES, BUILTIN_NAMES, string_names
 from .misc import get_list
 
 logger = logging.getLogger('rememberscript')
@@ -28,6 +35,10 @@ TRANSITIONS = '=?>'
 RETURN_TO = 'return=>'
 NOREPLY = 'noreply'
 EXTRA = 'extra'
+TIMER = 'timer'
+TIMER_AFTER = 'after'
+TIMER_EVERY = 'every'
+TIMER_MSG = 'msg'
 TO = '=>'
 SHOULD_TRIGGER = 'should_trigger'
 SHOULD_NOT_TRIGGER = 'should_not_trigger'
@@ -37,18 +48,86 @@ TransitionType = Dict[str, Any]
 StoryType = List[StateType]
 ScriptType = Dict[str, StoryType]
 
-def load_script(dir_path: str, story_name: str, storage: StorageType) -> ScriptType:
-    """Loads a single script yaml and py file,
-    Saves the local variables in the py file to 'storage'
+# Trigger used for transitions without any '?', it always succeeds but with
+# weight 0, so that any other successful trigger with weight > 0 overrides it
+DEFAULT_TRIGGER = '{{True}}[[weight = 0]]'
+
+ActionType = Union[CompiledString, dict]
+
+
+class CompiledTransition(NamedTuple):
+    """A transition with its target state, actions and return state"""
+    to: str
+    actions: Tuple[ActionType, ...]
+    return_to: Optional[str]
+    extra: dict
+
+
+class CompiledTimer(NamedTuple):
+    """A state's timer: after delay seconds in the state, msg is processed as
+    if it was received, and then again every interval seconds if set"""
+    delay: float
+    interval: Optional[float]
+    msg: str
+
+
+class CompiledState(NamedTuple):
+    """A state with pre-parsed actions and the (trigger, transition) pairs of
+    its local transitions in script order. names are the storage keys used by
+    its actions and local triggers"""
+    name: Optional[str]
+    position: int
+    triggers: Tuple[Tuple[CompiledString, CompiledTransition], ...]
+    prefilter: TriggerPrefilter
+    enter_actions: Tuple[ActionType, ...]
+    exit_actions: Tuple[ActionType, ...]
+    return_to: Optional[str]
+    noreply: bool
+    extra: dict
+    names: NameUsage
+    timer: Optional[CompiledTimer]
+
+
+class CompiledStory(NamedTuple):
+    """A story with its states and a map from state name to state index,
+    source is the loaded story it was compiled from"""
+    name: str
+    position: int
+    states: Tuple[CompiledState, ...]
+    state_index: Mapping[str, int]
+    source: StoryType
+
+
+class CompiledScript(NamedTuple):
+    """An immutable, indexed form of a script as used by RememberMachine
+
+    stories -- map from story name to story
+    story_names -- story names in order, i.e. map from story index to name
+    global_triggers -- (trigger, story name) pairs for the triggers of the
+                       init state of every story
+    global_prefilter -- prefilter for global_triggers
+    global_names -- the storage keys used by global_triggers
     """
-    yaml_path = os.path.join(dir_path, story_name+'.yaml')
-    py_path = os.path.join(dir_path, story_name+'.py')
-    script = None
-    with open(yaml_path, 'r') as yaml_data:
-        script = yaml.load(yaml_data.read())
+    stories: Mapping[str, CompiledStory]
+    story_names: Tuple[str, ...]
+    global_triggers: Tuple[Tuple[CompiledString, str], ...]
+    global_prefilter: TriggerPrefilter
+    global_names: NameUsage
+
+# The C loader is much faster, but isn't always compiled in
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Parse this many changed yaml files or more in worker processes
+PARALLEL_MIN_FILES = 16
+
+
+def _parse_yaml(data: Union[str, bytes]) -> StoryType:
+    return yaml.load(data, Loader=_YAML_LOADER)
 
+
+def _load_py(py_path: str, storage: StorageType) -> None:
     if not os.path.exists(py_path):
-        return script
+        return
 
     with open(py_path, 'r') as py_data:
         # Run the .py file and populate storage with
@@ -60,17 +139,100 @@ def load_script(dir_path: str, story_name: str, storage: StorageType) -> ScriptT
             logger.error(traceback.format_exc())
             raise
 
+
+def load_script(dir_path: str, story_name: str, storage: StorageType) -> StoryType:
+    """Loads a single script yaml and py file,
+    Saves the local variables in the py file to 'storage'
+    """
+    yaml_path = os.path.join(dir_path, story_name+'.yaml')
+    py_path = os.path.join(dir_path, story_name+'.py')
+    script = None
+    with open(yaml_path, 'r') as yaml_data:
+        script = _parse_yaml(yaml_data.read())
+
+    _load_py(py_path, storage)
     return script
 
 
-def load_scripts_dir(path: str, storage: StorageType) -> Dict[str, ScriptType]:
-    """Loads all scripts in a dir"""
-    scripts = {}
-    for yaml_filename in glob.glob(os.path.join(path, '*.yaml')):
-        story_name = os.path.basename(yaml_filename).split('.yaml')[0]
-        dir_path = os.path.dirname(yaml_filename)
-        scripts[story_name] = load_script(dir_path, story_name, storage)
-    return scripts
+class _CacheEntry(NamedTuple):
+    digest: bytes
+    story: StoryType
+
+
+# Parsed yaml files by story name, see load_scripts_dir
+ScriptCache = Dict[str, _CacheEntry]
+
+# Version of the script cache format, caches of other versions are ignored
+_CACHE_VERSION = 2
+
+def _load_cache(cache_path: str) -> ScriptCache:
+    try:
+        with open(cache_path, 'rb') as f:
+            version, cache = pickle.load(f)
+        return cache if version == _CACHE_VERSION else {}
+    except FileNotFoundError:
+        return {}
+    except:
+        logger.error("couldn't load script cache: %s" % cache_path)
+        logger.error(traceback.format_exc())
+        return {}
+
+
+def _parse_yaml_files(data: List[bytes], workers: Optional[int]) -> List[StoryType]:
+    if len(data) < PARALLEL_MIN_FILES and workers is None:
+        return [_parse_yaml(d) for d in data]
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(_parse_yaml, data, chunksize=4))
+
+
+def load_scripts_dir(path: str, storage: StorageType, cache_path: Optional[str]=None,
+                     workers: Optional[int]=None,
+                     cache: Optional[ScriptCache]=None) -> ScriptType:
+    """Loads all scripts in a dir
+
+    cache_path -- if given, the parsed yaml files are cached in this file and
+                  only parsed again when their content changes
+    workers -- number of processes to parse yaml files in, by default
+               processes are only used for PARALLEL_MIN_FILES or more files
+    cache -- if given, a dict kept between loads of the same dir in which the
+             parsed yaml files are cached in memory, filled from cache_path
+             when empty. The cached stories are shared, don't modify them
+    """
+    if cache is None:
+        cache = {}
+    if len(cache) == 0 and cache_path is not None:
+        cache.update(_load_cache(cache_path))
+    # In glob order, like the stories are loaded without a cache
+    stories: Dict[str, Any] = {}
+    changed: List[Tuple[str, bytes, bytes]] = []
+    for yaml_path in glob.glob(os.path.join(path, '*.yaml')):
+        story_name = os.path.basename(yaml_path).split('.yaml')[0]
+        with open(yaml_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).digest()
+        entry = cache.get(story_name, None)
+        if entry is not None and entry.digest == digest:
+            stories[story_name] = entry.story
+        else:
+            stories[story_name] = None
+            changed.append((story_name, data, digest))
+
+    parsed = _parse_yaml_files([data for _, data, _ in changed], workers)
+    for (story_name, _, digest), story in zip(changed, parsed):
+        stories[story_name] = story
+        cache[story_name] = _CacheEntry(digest, story)
+
+    removed = set(cache) - set(stories)
+    for story_name in removed:
+        del cache[story_name]
+    if cache_path is not None and (len(changed) > 0 or len(removed) > 0):
+        atomic_write(cache_path, pickle.dumps((_CACHE_VERSION, cache),
+                                       protocol=pickle.HIGHEST_PROTOCOL), 'b')
+
+    # The .py files populate storage, so they're run in this process
+    for story_name in stories:
+        _load_py(os.path.join(path, story_name+'.py'), storage)
+    return stories
 
 
 def _maybe_nested_types(obj, key, types):
@@ -91,15 +253,32 @@ def _maybe_nested_types(obj, key, types):
             assert is_one_of, error_msg
 
 
-async def _validate_trigger_examples(transition):
-    triggers = get_list(transition, TRIGGER)
+# Content hashes of the transitions whose trigger examples passed, see
+# validate_script, the dict is cleared when it reaches this size
+ValidatedExamples = Dict[str, None]
+VALIDATED_EXAMPLES_MAX = 65536
+
+
+def _transition_hash(transition: TransitionType) -> str:
+    data = json.dumps(transition, sort_keys=True, default=repr)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+async def _validate_trigger_examples(transition, validated: Optional[ValidatedExamples]):
     examples = ([(msg, True) for msg in get_list(transition, SHOULD_TRIGGER)] +
                 [(msg, False) for msg in get_list(transition, SHOULD_NOT_TRIGGER)])
+    if len(examples) == 0:
+        return
+    digest = _transition_hash(transition)
+    if validated is not None and digest in validated:
+        return
+    # Compile the triggers once for all the examples
+    triggers = [compile_string(trigger) for trigger in get_list(transition, TRIGGER)]
 
     # For each test example, first execute the string and use the final
     # string as the message; unless empty (emtpy messages are for setting storage
     # variables)
-    storage = {}
+    storage: StorageType = {}
     for msg, should_trigger in examples:
         msg = await execute_string(msg, storage)
         if msg == '':
@@ -114,8 +293,13 @@ async def _validate_trigger_examples(transition):
             'triggered' if should_trigger else "not triggered")
         assert match == should_trigger, info
 
+    if validated is not None:
+        if len(validated) >= VALIDATED_EXAMPLES_MAX:
+            validated.clear()
+        validated[digest] = None
+
 
-async def _validate_transition(transition):
+async def _validate_transition(transition, validated: Optional[ValidatedExamples]):
     valid_keys = {TO, ACTION, TRIGGER, RETURN_TO, SHOULD_TRIGGER, SHOULD_NOT_TRIGGER}
     key_diff = set(transition.keys()) - valid_keys
     assert len(key_diff) == 0, 'Unkown keys %s' % str(key_diff)
@@ -127,12 +311,12 @@ async def _validate_transition(transition):
     _maybe_nested_types(transition, ACTION, [str, dict])
     _maybe_nested_types(transition, SHOULD_TRIGGER, [str])
     _maybe_nested_types(transition, SHOULD_NOT_TRIGGER, [str])
-    await _validate_trigger_examples(transition)
+    await _validate_trigger_examples(transition, validated)
 
 
-async def _validate_state(state):
+async def _validate_state(state, validated: Optional[ValidatedExamples]):
     valid_keys = {STATE_NAME, TRIGGER, ENTER_ACTION, EXIT_ACTION, TRANSITIONS,
-                  NOREPLY, EXTRA, RETURN_TO}
+                  NOREPLY, EXTRA, RETURN_TO, TIMER}
     assert len(set(state.keys()) - valid_keys) == 0
     assert isinstance(state, dict), 'State should be dict'
     assert isinstance(state.get(STATE_NAME, ''), str), 'Name should be string'
@@ -140,7 +324,7 @@ async def _validate_state(state):
         trans = state[TRANSITIONS]
         trans = [trans] if isinstance(trans, dict) else trans
         for t in trans:
-            await _validate_transition(t)
+            await _validate_transition(t, validated)
 
     _maybe_nested_types(state, TO, [str])
     for key in [ENTER_ACTION, EXIT_ACTION]:
@@ -149,17 +333,225 @@ async def _validate_state(state):
     assert isinstance(state.get(NOREPLY, False), bool), 'noreply type must be bool'
     assert isinstance(state.get(EXTRA, {}), dict), 'extra type must be dict'
     assert isinstance(state.get(RETURN_TO, ''), str), '"return_to" should be str'
+    if TIMER in state:
+        _validate_timer(state[TIMER])
+
+
+def _validate_timer(timer):
+    assert isinstance(timer, dict), 'timer should be dict'
+    key_diff = set(timer.keys()) - {TIMER_AFTER, TIMER_EVERY, TIMER_MSG}
+    assert len(key_diff) == 0, 'Unkown timer keys %s' % str(key_diff)
+    assert TIMER_AFTER in timer or TIMER_EVERY in timer, 'timer needs "after" or "every"'
+    for key in [TIMER_AFTER, TIMER_EVERY]:
+        value = timer.get(key, 1)
+        assert isinstance(value, (int, float)) and value >= 0, '"%s" should be a number' % key
+    assert timer.get(TIMER_EVERY, 1) > 0, '"every" should be positive'
+    assert isinstance(timer.get(TIMER_MSG, ''), str), 'timer "msg" should be str'
+
+
+def _script_strings(script: ScriptType) -> Iterator[Tuple[str, bool]]:
+    """Yields (string, is trigger) for every trigger and action in a script"""
+    for states in script.values():
+        for state in states:
+            for trigger in get_list(state, TRIGGER):
+                yield trigger, True
+            for key in [ENTER_ACTION, EXIT_ACTION]:
+                for action in get_list(state, key):
+                    yield action, False
+            for trans in get_list(state, TRANSITIONS):
+                for trigger in get_list(trans, TRIGGER):
+                    yield trigger, True
+                for action in get_list(trans, ACTION):
+                    yield action, False
+
+
+def _validate_names(script: ScriptType, storage: StorageType) -> None:
+    """Checks that every name read by the script's code blocks is defined,
+    i.e. it's in storage, set by the machine or written somewhere in the script"""
+    usages = [(string, string_names(compile_string(string), trigger))
+              for string, trigger in _script_strings(script) if isinstance(string, str)]
+    defined = set(storage.keys()) | MACHINE_NAMES | BUILTIN_NAMES
+    for _, usage in usages:
+        defined |= usage.writes
+
+    for string, usage in usages:
+        undefined = usage.reads - defined
+        assert len(undefined) == 0, 'Undefined names %s in "%s"' % (
+            ', '.join(sorted(undefined)), string)
+
+
+# Targets of '=>' and 'return=>' that aren't state or story names
+KEYWORDS = frozenset(['next', 'prev', 'loopback', 'return'])
+
+# The state names of every story, by story name
+NameIndex = Dict[str, FrozenSet[str]]
+
+
+def _name_index(script: ScriptType) -> NameIndex:
+    return {name: frozenset(state[STATE_NAME] for state in states if STATE_NAME in state)
+            for name, states in script.items()}
+
+
+def _validate_references(story: str, states: StoryType, index: NameIndex) -> None:
+    """Checks that the states and stories referenced by transitions exist,
+    i.e. are keywords, states of the story or other stories. Returning to a
+    state ('return=>') also resolves in the story of the transition"""
+    for state in states:
+        targets = [(TO, trans.get(TO, None)) for trans in get_list(state, TRANSITIONS)]
+        targets += [(RETURN_TO, trans.get(RETURN_TO, None))
+                    for trans in get_list(state, TRANSITIONS)]
+        targets.append((RETURN_TO, state.get(RETURN_TO, None)))
+        for key, target in targets:
+            if not target or target in KEYWORDS:
+                continue
+            assert target in index[story] or target in index, (
+                '"%s" in state "%s" of story "%s" is neither a state of the '
+                'story nor a story' % (target, state.get(STATE_NAME, ''), story))
+
 
+async def _validate_story(story: str, states: StoryType,
+                          validated: Optional[ValidatedExamples]) -> None:
+    assert isinstance(states, list), 'States should be list'
+    assert len(states) > 0 and states[0][STATE_NAME] == 'init', 'First state should be init'
+    for state in states:
+        await _validate_state(state, validated)
 
-async def validate_script(script):
-    """Validate a loaded yaml script"""
+
+async def validate_script(script, storage: Optional[StorageType]=None,
+                          stories: Optional[Iterable[str]]=None,
+                          validated: Optional[ValidatedExamples]=None):
+    """Validate a loaded yaml script, stories are validated concurrently and
+    the first error is raised
+
+    storage -- if given, also check that the names read by code blocks are
+               defined, e.g. the storage the script was loaded with
+    stories -- only validate the states of these stories, e.g. the ones
+               that changed since the script was last validated. The
+               references between stories are always checked
+    validated -- if given, a dict that keeps the hashes of the transitions
+                 whose trigger examples passed, so that validating with it
+                 again only runs the examples of changed transitions
+    """
     assert isinstance(script, dict), 'Script should be dict'
     assert 'init' in script, "There needs to be an 'init' story in the script"
 
-    for _, states in script.items():
-        assert len(states) > 0 and states[0][STATE_NAME] == 'init', 'First state should be init'
-        assert isinstance(states, list), 'States should be list'
-        for state in states:
-            await _validate_state(state)
+    index = _name_index(script)
+    names = script.keys() if stories is None else stories
+    tasks = [asyncio.ensure_future(_validate_story(name, script[name], validated))
+             for name in names]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Stop validating the other stories once one failed
+        for task in tasks:
+            task.cancel()
+    for name, states in script.items():
+        _validate_references(name, states, index)
+
+    if storage is not None:
+        _validate_names(script, storage)
+
+
+def _compile_actions(obj: dict, key: str) -> Tuple[ActionType, ...]:
+    return tuple(compile_string(action) if isinstance(action, str) else action
+                 for action in get_list(obj, key))
+
+
+def _actions_names(actions: Tuple[ActionType, ...]) -> NameUsage:
+    usage = NO_NAMES
+    for action in actions:
+        if isinstance(action, CompiledString):
+            usage |= string_names(action)
+    return usage
+
+
+def _triggers_names(triggers: Tuple[CompiledString, ...]) -> NameUsage:
+    usage = NO_NAMES
+    for trigger in triggers:
+        usage |= string_names(trigger, trigger=True)
+    return usage
 
-    #TODO: validate that referenced states exist
+
+def _compile_state(state: StateType, index: int) -> CompiledState:
+    default_return = state.get(RETURN_TO, None)
+    triggers = []
+    for trans in get_list(state, TRANSITIONS):
+        transition = CompiledTransition(trans.get(TO, 'next'),
+                                        _compile_actions(trans, ACTION),
+                                        trans.get(RETURN_TO, default_return),
+                                        trans.get(EXTRA, {}))
+        for trigger in get_list(trans, TRIGGER, [DEFAULT_TRIGGER]):
+            triggers.append((compile_string(trigger), transition))
+
+    prefilter = TriggerPrefilter([trigger for trigger, _ in triggers])
+    enter_actions = _compile_actions(state, ENTER_ACTION)
+    exit_actions = _compile_actions(state, EXIT_ACTION)
+    names = (_triggers_names(tuple(trigger for trigger, _ in triggers)) |
+             _actions_names(enter_actions) | _actions_names(exit_actions))
+    for transition in {id(t): t for _, t in triggers}.values():
+        names |= _actions_names(transition.actions)
+    return CompiledState(state.get(STATE_NAME, None), index, tuple(triggers), prefilter,
+                         enter_actions, exit_actions, default_return,
+                         state.get(NOREPLY, False), state.get(EXTRA, {}), names,
+                         _compile_timer(state.get(TIMER, None)))
+
+
+def _compile_timer(timer: Optional[dict]) -> Optional[CompiledTimer]:
+    if timer is None:
+        return None
+    interval = timer.get(TIMER_EVERY, None)
+    # A validated timer has "after", "every" or both
+    return CompiledTimer(timer.get(TIMER_AFTER, interval) or 0.0, interval,
+                         timer.get(TIMER_MSG, ''))
+
+
+def _compile_story(name: str, index: int, states: StoryType) -> CompiledStory:
+    compiled_states = tuple(_compile_state(state, i) for i, state in enumerate(states))
+    state_index: Dict[str, int] = {}
+    for state in compiled_states:
+        if state.name is not None:
+            state_index.setdefault(state.name, state.position)
+    return CompiledStory(name, index, compiled_states, MappingProxyType(state_index), states)
+
+
+def compile_script(script: ScriptType, previous: Optional[CompiledScript]=None,
+                   changed: Iterable[str]=(), prune: bool=False) -> CompiledScript:
+    """Compiles a loaded (and validated) yaml script into the form run by
+    RememberMachine, so that nothing has to be looked up in the raw script
+    dicts when processing a message
+
+    previous -- an earlier compiled version of the script, its stories are
+                reused unless their names are in changed
+    prune -- remove the local triggers that can never win, see
+             graph.dead_triggers. If the global triggers changed, the
+             stories of previous are compiled again before pruning, as
+             their triggers were pruned against the old ones
+    """
+    changed = set(changed)
+    global_triggers = tuple((compile_string(trigger), name)
+                            for name, states in script.items()
+                            for trigger in get_list(states[0], TRIGGER))
+    recompile = prune and previous is not None and (
+        [(trigger.source, name) for trigger, name in previous.global_triggers] !=
+        [(trigger.source, name) for trigger, name in global_triggers])
+    stories = {}
+    for i, (name, states) in enumerate(script.items()):
+        story = previous.stories.get(name, None) if previous is not None else None
+        if story is None or name in changed:
+            story = _compile_story(name, i, states)
+        elif recompile:
+            # Keep the source, so that RememberMachine.reload knows the
+            # states are the same
+            story = _compile_story(name, i, story.source)
+        elif story.position != i:
+            story = story._replace(position=i)
+        stories[name] = story
+    global_prefilter = TriggerPrefilter([trigger for trigger, _ in global_triggers])
+    global_names = _triggers_names(tuple(trigger for trigger, _ in global_triggers))
+    compiled = CompiledScript(MappingProxyType(stories), tuple(script.keys()),
+                              global_triggers, global_prefilter, global_names)
+    if prune:
+        # The graph module builds on this one
+        from .graph import prune_triggers
+        compiled = prune_triggers(compiled)
+    return compiled
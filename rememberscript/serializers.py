@@ -0,0 +1,189 @@
+"""
+Codecs for serializing single storage values, and a registry for choosing a
+codec per key or per value type
+
+A codec is selected by name when encoding, and the name is stored with the
+encoded value so it can be decoded with the same codec.
+"""
+import sys
+import json
+import pickle
+import struct
+import marshal
+from array import array
+from typing import Any, Callable, Dict, Final, NamedTuple, Tuple, Union
+
+BytesLike = Union[bytes, memoryview]
+
+
+class Codec(NamedTuple):
+    name: str
+    encode: Callable[[Any], bytes]
+    decode: Callable[[BytesLike], Any]
+
+
+_PICKLE_HEADER = struct.Struct('>II')
+_BUFFER_LENGTH = struct.Struct('>Q')
+
+def _pickle_encode(value: Any) -> bytes:
+    """Pickles with protocol 5 (if available), keeping large buffers (e.g.
+    bytearrays or numpy arrays) out-of-band, after the pickle data, instead
+    of copying them into it"""
+    buffers: list = []
+    if pickle.HIGHEST_PROTOCOL >= 5:
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    else:
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    raw = [buffer.raw() for buffer in buffers]
+    return b''.join([_PICKLE_HEADER.pack(len(raw), len(data))] +
+                    [_BUFFER_LENGTH.pack(len(r)) for r in raw] + [data] + raw)
+
+def _pickle_decode(data: BytesLike) -> Any:
+    data = memoryview(data)
+    n_buffers, data_len = _PICKLE_HEADER.unpack_from(data)
+    offset = _PICKLE_HEADER.size
+    lengths = []
+    for _ in range(n_buffers):
+        lengths.append(_BUFFER_LENGTH.unpack_from(data, offset)[0])
+        offset += _BUFFER_LENGTH.size
+    pickle_data = data[offset:offset+data_len]
+    offset += data_len
+    buffers = []
+    for length in lengths:
+        buffers.append(data[offset:offset+length])
+        offset += length
+    if len(buffers) == 0:
+        return pickle.loads(pickle_data)
+    return pickle.loads(pickle_data, buffers=buffers)
+
+
+# Typecodes of the array codec, the first byte of the encoded value
+_INT_TYPECODE: Final = 'q'
+_FLOAT_TYPECODE: Final = 'd'
+
+def _array_encode(value: Any) -> bytes:
+    """Encodes a list of only ints (that fit in 64 bits) or only floats as
+    the raw bytes of an array, in little endian order"""
+    if not isinstance(value, list):
+        raise TypeError('array codec only encodes lists')
+    if all(type(item) is int for item in value):
+        typecode = _INT_TYPECODE
+    elif all(type(item) is float for item in value):
+        typecode = _FLOAT_TYPECODE
+    else:
+        raise TypeError('array codec only encodes lists of only ints or only floats')
+
+    values = array(typecode, value)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return typecode.encode('ascii') + values.tobytes()
+
+def _array_decode(data: BytesLike) -> Any:
+    data = memoryview(data)
+    typecode = chr(data[0])
+    if sys.byteorder == 'big':
+        values = array(typecode, data[1:].tobytes())
+        values.byteswap()
+        return values.tolist()
+    # Read the values directly from the (possibly memory mapped) buffer
+    if typecode == _INT_TYPECODE:
+        return data[1:].cast(_INT_TYPECODE).tolist()
+    if typecode == _FLOAT_TYPECODE:
+        return data[1:].cast(_FLOAT_TYPECODE).tolist()
+    raise ValueError('unknown array typecode %r' % typecode)
+
+
+# Types that json decodes to the same type, exactly
+_JSON_SCALARS = (str, int, float, bool, type(None))
+
+def _check_json(value: Any) -> None:
+    """Raises TypeError if value wouldn't be decoded as an equal value, e.g.
+    tuples (which become lists) or dicts with keys that aren't str"""
+    stack = [value]
+    containers = set()
+    while len(stack) > 0:
+        value = stack.pop()
+        if type(value) in _JSON_SCALARS:
+            continue
+        if id(value) in containers:
+            # Shared values would be copied, and circular ones can't be encoded
+            raise ValueError('json codec only encodes trees of values')
+        containers.add(id(value))
+        if type(value) is list:
+            stack.extend(value)
+        elif type(value) is dict:
+            if not all(type(key) is str for key in value):
+                raise TypeError('json codec only encodes dicts with str keys')
+            stack.extend(value.values())
+        else:
+            raise TypeError('json codec can\'t encode %s' % type(value).__name__)
+
+def _json_encode(value: Any) -> bytes:
+    _check_json(value)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def _json_decode(data: BytesLike) -> Any:
+    return json.loads(bytes(data))
+
+
+def _marshal_decode(data: BytesLike) -> Any:
+    return marshal.loads(bytes(data))
+
+
+PICKLE = Codec('pickle', _pickle_encode, _pickle_decode)
+MARSHAL = Codec('marshal', marshal.dumps, _marshal_decode)
+JSON = Codec('json', _json_encode, _json_decode)
+ARRAY = Codec('array', _array_encode, _array_decode)
+
+
+class CodecRegistry:
+    """Selects the codec for a storage value, by key, then by the value's type
+    (including base classes) and otherwise the default codec. If the selected
+    codec can't encode a value, the default codec is used instead.
+
+    The built-in codecs pickle (protocol 5 with out-of-band buffers), marshal,
+    json and array (lists of numbers) are always registered.
+    """
+    def __init__(self, default: str='pickle') -> None:
+        self._codecs: Dict[str, Codec] = {}
+        self._by_key: Dict[str, str] = {}
+        self._by_type: Dict[type, str] = {}
+        for codec in [PICKLE, MARSHAL, JSON, ARRAY]:
+            self.register(codec)
+        self.default = self[default]
+
+    def register(self, codec: Codec) -> None:
+        self._codecs[codec.name] = codec
+
+    def use_for_key(self, key: str, name: str) -> None:
+        self._by_key[key] = self[name].name
+
+    def use_for_type(self, value_type: type, name: str) -> None:
+        self._by_type[value_type] = self[name].name
+
+    def __getitem__(self, name: str) -> Codec:
+        if name not in self._codecs:
+            raise KeyError('No such codec: %s' % name)
+        return self._codecs[name]
+
+    def select(self, key: str, value: Any) -> Codec:
+        name = self._by_key.get(key, None)
+        if name is None:
+            for value_type in type(value).__mro__:
+                name = self._by_type.get(value_type, None)
+                if name is not None:
+                    break
+        return self._codecs[name] if name is not None else self.default
+
+    def encode(self, key: str, value: Any) -> Tuple[str, bytes]:
+        """Returns the name of the codec used and the encoded value"""
+        codec = self.select(key, value)
+        try:
+            return codec.name, codec.encode(value)
+        except (TypeError, ValueError, OverflowError):
+            if codec is self.default:
+                raise
+        return self.default.name, self.default.encode(value)
+
+    def decode(self, name: str, data: BytesLike) -> Any:
+        return self[name].decode(data)
@@ -0,0 +1,234 @@
+"""
+Sharding of sessions across worker processes, to use more than one core
+
+The scripts are loaded and compiled once in the front-end process, and the
+workers are forked from it, before its event loop runs, so that they share
+the compiled script copy-on-write. Every worker runs a MachinePool on its own event loop, and
+session ids are hashed to workers, so a session always runs in the same
+worker. Requests and replies are pickled frames sent over a socket pair per
+worker.
+"""
+import os
+import json
+import zlib
+import pickle
+import socket
+import struct
+import asyncio
+import logging
+import traceback
+import multiprocessing
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional
+from .messages import Message, Encoder, Encoded, encode_all
+from .pool import MachinePool
+from .script import load_scripts_dir, validate_script, compile_script
+
+logger = logging.getLogger('rememberscript')
+
+_FRAME_HEADER = struct.Struct('>I')
+
+# Frame kinds, requests are (kind, request id, session id, msg) and
+# responses (kind, request id, payload)
+_REPLY = 0
+_END = 1
+_ERROR = 2
+_CLOSE = 3
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Any:
+    header = await reader.readexactly(_FRAME_HEADER.size)
+    return pickle.loads(await reader.readexactly(_FRAME_HEADER.unpack(header)[0]))
+
+
+def _write_frame(writer: asyncio.StreamWriter, frame: Any) -> None:
+    data = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(_FRAME_HEADER.pack(len(data)) + data)
+
+
+def shard(session_id: Hashable, n_workers: int) -> int:
+    """Returns the worker of a session, stable across processes and runs"""
+    return zlib.crc32(str(session_id).encode('utf-8')) % n_workers
+
+
+class _Worker:
+    """The front-end side of a worker process"""
+    def __init__(self, process: multiprocessing.process.BaseProcess,
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.process = process
+        self.reader = reader
+        self.writer = writer
+        self.requests: Dict[int, asyncio.Queue] = {}
+        self.task = asyncio.ensure_future(self._read())
+
+    async def _read(self) -> None:
+        """Routes the response frames to the queues of their requests"""
+        try:
+            while True:
+                kind, request_id, payload = await _read_frame(self.reader)
+                queue = self.requests.get(request_id, None)
+                if queue is not None:
+                    queue.put_nowait((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        # The worker is gone, fail the requests still waiting for it
+        for queue in self.requests.values():
+            queue.put_nowait((_ERROR, RuntimeError('Worker process exited')))
+
+
+class ShardedPool:
+    """Runs the sessions of a scripts dir in worker processes, with the same
+    reply() and replies() as MachinePool
+
+    path -- the scripts dir, loaded once before forking the workers
+    workers -- number of worker processes, defaults to the number of cores
+    **pool_kwargs -- passed on to the MachinePool of every worker, e.g. a
+                     storage_factory, these aren't pickled
+
+    start() forks the workers and has to be called before the event loop
+    runs, e.g. before asyncio.run(). The workers are connected to on the
+    first request.
+
+    Note: requires the fork start method, i.e. a POSIX system
+    """
+    def __init__(self, path: str, workers: Optional[int]=None, **pool_kwargs: Any) -> None:
+        self.path = path
+        self.n_workers = workers or os.cpu_count() or 1
+        self._pool_kwargs = pool_kwargs
+        self._processes: List[multiprocessing.process.BaseProcess] = []
+        self._workers: List[_Worker] = []
+        # The front-end ends of the socket pairs, which workers close
+        self._sockets: List[socket.socket] = []
+        self._connecting: Optional[asyncio.Future] = None
+        self._next_request = 0
+
+    def start(self) -> None:
+        """Loads, validates and compiles the scripts and forks the workers"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError('ShardedPool.start() has to be called before the event loop runs')
+        defaults: Dict[str, Any] = {}
+        script = load_scripts_dir(self.path, defaults)
+        asyncio.run(validate_script(script, defaults))
+        compiled = compile_script(script)
+
+        context = multiprocessing.get_context('fork')
+        for _ in range(self.n_workers):
+            parent, child = socket.socketpair()
+            self._sockets.append(parent)
+            process = context.Process(target=_worker_main, daemon=True, args=(
+                child, list(self._sockets), compiled, defaults, self._pool_kwargs))
+            process.start()
+            child.close()
+            self._processes.append(process)
+
+    async def _connect(self) -> None:
+        """Opens the connections to the workers, once"""
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._open_connections())
+        await asyncio.shield(self._connecting)
+
+    async def _open_connections(self) -> None:
+        assert len(self._processes) > 0, 'ShardedPool.start() has to be called first'
+        workers = []
+        for process, parent in zip(self._processes, self._sockets):
+            reader, writer = await asyncio.open_connection(sock=parent)
+            workers.append(_Worker(process, reader, writer))
+        self._workers = workers
+
+    async def reply(self, session_id: Hashable, msg: str,
+                    dumps: Encoder=json.dumps) -> AsyncIterator[Encoded]:
+        """Processes a message in the worker of the session and yields the
+        replies as they're streamed back, like MachinePool.reply"""
+        async for m in encode_all(self.replies(session_id, msg), dumps):
+            yield m
+
+    async def replies(self, session_id: Hashable, msg: str) -> AsyncIterator[Message]:
+        """Same as reply, but yields Messages"""
+        await self._connect()
+        worker = self._workers[shard(session_id, len(self._workers))]
+        if worker.task.done():
+            raise RuntimeError('Worker process exited')
+        request_id = self._next_request
+        self._next_request += 1
+        queue: asyncio.Queue = asyncio.Queue()
+        worker.requests[request_id] = queue
+        try:
+            _write_frame(worker.writer, (_REPLY, request_id, session_id, msg))
+            await worker.writer.drain()
+            while True:
+                kind, payload = await queue.get()
+                if kind == _END:
+                    return
+                if kind == _ERROR:
+                    raise payload
+                yield payload
+        finally:
+            del worker.requests[request_id]
+
+    async def close(self) -> None:
+        """Closes the pools of the workers, syncing their storages, and
+        waits for the workers to exit"""
+        await self._connect()
+        for worker in self._workers:
+            _write_frame(worker.writer, (_CLOSE, -1, None, None))
+            await worker.writer.drain()
+        for worker in self._workers:
+            await worker.task
+            worker.writer.close()
+            await asyncio.get_event_loop().run_in_executor(None, worker.process.join)
+        self._processes = []
+        self._workers = []
+        self._sockets = []
+        self._connecting = None
+
+
+def _worker_main(sock: socket.socket, inherited: List[socket.socket], script: Any,
+                 defaults: Dict[str, Any], pool_kwargs: Dict[str, Any]) -> None:
+    # Close the sockets of the front-end, including those of the other workers
+    for parent in inherited:
+        parent.close()
+    asyncio.run(_serve(sock, MachinePool(script, defaults, **pool_kwargs)))
+
+
+async def _serve(sock: socket.socket, pool: MachinePool) -> None:
+    """Processes requests concurrently until the front-end closes the pool"""
+    reader, writer = await asyncio.open_connection(sock=sock)
+    tasks = set()
+    while True:
+        try:
+            kind, request_id, session_id, msg = await _read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+        if kind == _CLOSE:
+            break
+        task = asyncio.ensure_future(_process(writer, pool, request_id, session_id, msg))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if len(tasks) > 0:
+        await asyncio.wait(tasks)
+    await pool.close()
+    writer.close()
+
+
+async def _process(writer: asyncio.StreamWriter, pool: MachinePool, request_id: int,
+                   session_id: Hashable, msg: str) -> None:
+    try:
+        async for m in pool.replies(session_id, msg):
+            _write_frame(writer, (_REPLY, request_id, m))
+            # Wait while the front-end is behind
+            await writer.drain()
+    except Exception as e:
+        logger.error('reply failed in worker %i' % os.getpid())
+        logger.error(traceback.format_exc())
+        try:
+            pickle.dumps(e)
+        except:
+            e = RuntimeError(repr(e))
+        _write_frame(writer, (_ERROR, request_id, e))
+    else:
+        _write_frame(writer, (_END, request_id, None))
+    await writer.drain()
@@ -0,0 +1,141 @@
+"""
+SQLite backed storage, for running many sessions on one host without a file
+per session. All sessions share one SQLiteDatabase, which stores one row per
+(session, key) and commits the syncs of many sessions in a single transaction.
+"""
+import asyncio
+import pickle
+import sqlite3
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Union
+from .storage import TrackingStorage
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS storage (
+    session TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    PRIMARY KEY (session, key)
+) WITHOUT ROWID'''
+
+# (session, changed (key, value) pairs, deleted keys)
+_WriteType = Tuple[str, List[Tuple[str, bytes]], List[str]]
+
+
+class SQLiteDatabase:
+    """A sqlite database file shared by the SQLiteStorages of many sessions
+
+    All database calls run on a dedicated thread. Writes are queued and the
+    writes of all storages that sync during the same event loop iteration are
+    committed together in one transaction, using the write-ahead log.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._connection: Union[sqlite3.Connection, None] = None
+        self._pending: List[Tuple[_WriteType, asyncio.Future]] = []
+
+    async def read(self, session: str, keys: Optional[Iterable[str]]=None) -> List[Tuple[str, bytes]]:
+        """Returns (key, value) rows of a session, optionally only for keys"""
+        if keys is None:
+            return await self._run(self._select, session)
+        return await self._run(self._select_keys, session, list(keys))
+
+    async def write(self, session: str, changed: List[Tuple[str, bytes]],
+                    deleted: List[str]) -> None:
+        """Writes rows of a session, returns when they're committed"""
+        future = asyncio.get_event_loop().create_future()
+        if len(self._pending) == 0:
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._pending.append(((session, changed, deleted), future))
+        await future
+
+    async def close(self) -> None:
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        self._executor.shutdown()
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, []
+        task = self._run(self._write_batch, [write for write, _ in pending])
+
+        def done(task):
+            for _, future in pending:
+                if future.cancelled():
+                    continue
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(None)
+        asyncio.ensure_future(task).add_done_callback(done)
+
+    async def _run(self, func: Callable, *args: Any) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, partial(func, *args))
+
+    # The methods below run on the database thread
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.filename, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _select(self, session: str) -> List[Tuple[str, bytes]]:
+        return self._connect().execute(
+            'SELECT key, value FROM storage WHERE session = ?', (session,)).fetchall()
+
+    def _select_keys(self, session: str, keys: List[str]) -> List[Tuple[str, bytes]]:
+        connection = self._connect()
+        return [row for key in keys for row in connection.execute(
+            'SELECT key, value FROM storage WHERE session = ? AND key = ?',
+            (session, key))]
+
+    def _write_batch(self, writes: List[_WriteType]) -> None:
+        connection = self._connect()
+        connection.execute('BEGIN')
+        try:
+            for session, changed, deleted in writes:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO storage (session, key, value) VALUES (?, ?, ?)',
+                    [(session, key, value) for key, value in changed])
+                connection.executemany(
+                    'DELETE FROM storage WHERE session = ? AND key = ?',
+                    [(session, key) for key in deleted])
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+
+class SQLiteStorage(TrackingStorage):
+    """A storage class that behaves like dict, but persists public entries as
+    rows of a SQLiteDatabase, with the same load() and sync() as FileStorage
+    Note: private entries start with an _ (underscore)"""
+    def __init__(self, database: SQLiteDatabase, session: str,
+                 serializer=pickle, mode='b') -> None:
+        super().__init__(serializer, mode)
+        self.database = database
+        self.session = session
+
+    async def load(self, keys: Optional[Iterable[str]]=None) -> None:
+        """Sync from the database, overwrites exisiting dict entries but
+        doesn't delete existing
+
+        keys -- only load these keys, defaults to all keys of the session
+        """
+        for key, data in await self.database.read(self.session, keys):
+            self._dict[key] = self._loads(data)
+            self._persisted.add(key)
+
+    async def sync(self) -> None:
+        """Sync the entries changed since the last sync to the database"""
+        await self._run_sync_hooks()
+        await self._write_changes(partial(self.database.write, self.session))
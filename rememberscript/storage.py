@@ -3,12 +3,15 @@ import os
 import asyncio
 import pickle
 import json
+import mmap
+import struct
 import inspect
 from functools import partial
-from collections import MutableMapping
+from collections import MutableMapping, ChainMap
 from typing import MutableMapping as MutableMappingType
-from typing import Any
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from types import FunctionType
+from .serializers import CodecRegistry, BytesLike
 
 StorageType = MutableMappingType[str, Any]
 
@@ -25,26 +28,277 @@ def _sync_var(key, var):
             not inspect.isclass(var) and
             not inspect.ismodule(var))
 
-def _dump(filename, data, mode=''):
-    with open(filename, 'w'+mode) as f:
+def atomic_write(filename, data, mode=''):
+    """Writes data to a temporary file and renames it to filename, so that
+    filename is never left half written"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w'+mode) as f:
         f.write(data)
+    os.replace(tmp_filename, filename)
 
 def _load(filename, mode=''):
+    if not os.path.exists(filename):
+        return None
     with open(filename, 'r'+mode) as f:
         return f.read()
 
 
-class FileStorage(MutableMapping):
+# Incremental file format: LOG_MAGIC, a key index and then records of a
+# header (op, key length, codec name length, value length), the utf-8 key,
+# the codec name and the serialized value. An empty codec name means the
+# storage's serializer. Later records override earlier ones, a delete record
+# removes the key.
+#
+# The index is written when the file is compacted: a header (number of
+# entries, offset of the first record after the compacted ones) and for every
+# compacted entry (key length, codec name length, value offset, value length),
+# the key and the codec name. This lets a lazy load() read only the index and
+# the records appended since the compaction.
+LOG_MAGIC = b'RSLOG3\n'
+_INDEX_HEADER = struct.Struct('>IQ')
+_INDEX_ENTRY = struct.Struct('>IBQQ')
+_RECORD_HEADER = struct.Struct('>BIBI')
+_SET = 1
+_DELETE = 2
+
+_BUILTIN_CODECS = CodecRegistry()
+
+# Values of these types can't be changed in place, so reading them doesn't
+# make their key dirty
+_IMMUTABLE_TYPES = (int, float, complex, str, bytes, bool, type(None))
+
+IndexType = Dict[str, Tuple[str, BytesLike]]
+
+def _encode_record(op: int, key: str, codec: str='', data: bytes=b'') -> bytes:
+    key_data = key.encode('utf-8')
+    codec_data = codec.encode('ascii')
+    return (_RECORD_HEADER.pack(op, len(key_data), len(codec_data), len(data)) +
+            key_data + codec_data + data)
+
+def _encode_log(entries: List[Tuple[str, str, bytes]]) -> bytes:
+    """Encodes (key, codec name, value data) entries as a compacted log file"""
+    encoded = [(key.encode('utf-8'), codec.encode('ascii'), data)
+               for key, codec, data in entries]
+    index_size = sum(_INDEX_ENTRY.size + len(key) + len(codec) for key, codec, _ in encoded)
+    offset = len(LOG_MAGIC) + _INDEX_HEADER.size + index_size
+    index = []
+    records = []
+    for key, codec, data in encoded:
+        header = _RECORD_HEADER.pack(_SET, len(key), len(codec), len(data))
+        value_offset = offset + len(header) + len(key) + len(codec)
+        index.append(_INDEX_ENTRY.pack(len(key), len(codec), value_offset, len(data)) +
+                     key + codec)
+        records.append(header + key + codec + data)
+        offset = value_offset + len(data)
+    return b''.join([LOG_MAGIC, _INDEX_HEADER.pack(len(index), offset)] + index + records)
+
+def _decode_index(data: BytesLike) -> Tuple[IndexType, int]:
+    """Returns the compacted entries, key: (codec name, value data), and the
+    offset of the first appended record"""
+    n_entries, records_end = _INDEX_HEADER.unpack_from(data, len(LOG_MAGIC))
+    offset = len(LOG_MAGIC) + _INDEX_HEADER.size
+    entries: IndexType = {}
+    for _ in range(n_entries):
+        key_len, codec_len, value_offset, value_len = _INDEX_ENTRY.unpack_from(data, offset)
+        offset += _INDEX_ENTRY.size
+        key = bytes(data[offset:offset+key_len]).decode('utf-8')
+        offset += key_len
+        codec = bytes(data[offset:offset+codec_len]).decode('ascii')
+        offset += codec_len
+        entries[key] = (codec, data[value_offset:value_offset+value_len])
+    return entries, records_end
+
+def _decode_records(data: BytesLike, offset: int) -> Iterator[Tuple[int, str, str, BytesLike, int]]:
+    """Yields (op, key, codec name, value data, end offset) for the records in
+    a log file from offset, data is the whole file, e.g. bytes or a memoryview
+    of a mmap"""
+    header = _RECORD_HEADER
+    while offset + header.size <= len(data):
+        op, key_len, codec_len, data_len = header.unpack_from(data, offset)
+        offset += header.size
+        if offset + key_len + codec_len + data_len > len(data):
+            # Partially written record, e.g. the process died while syncing
+            return
+        key = bytes(data[offset:offset+key_len]).decode('utf-8')
+        offset += key_len
+        codec = bytes(data[offset:offset+codec_len]).decode('ascii')
+        offset += codec_len + data_len
+        yield op, key, codec, data[offset-data_len:offset], offset
+
+def _is_log(data: BytesLike) -> bool:
+    return bytes(data[:len(LOG_MAGIC)]) == LOG_MAGIC
+
+def _map_file(filename):
+    """Memory maps a file read-only, returns None if it's missing or empty"""
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return None
+    with open(filename, 'rb') as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def _append(filename, data):
+    with open(filename, 'ab') as f:
+        f.write(data)
+
+
+class TrackingStorage(MutableMapping):
+    """Base class for storages that behave like dict and keep track of the
+    entries changed since the last sync, so that only those need to be written
+
+    An entry is changed when it's set, deleted or read if its value is mutable
+    (since it could have been changed in place), or when the value's
+    __sync_hook__ has run.
+
+    Subclasses can also add lazy entries, which are only decoded (with
+    _decode_lazy) when first read. Note: repr() only shows decoded entries.
+    """
+    def __init__(self, serializer=pickle, mode='b'):
+        self._dict = {}
+        self._lazy: Dict[str, Any] = {}
+        self._serializer = serializer
+        self._mode = mode
+        # Keys changed since the last sync and keys that have been persisted
+        self._dirty: Set[str] = set()
+        self._persisted: Set[str] = set()
+
+    async def _run_sync_hooks(self):
+        for key, var in self._dict.items():
+            if not hasattr(var, '__sync_hook__'):
+                continue
+
+            if inspect.iscoroutinefunction(var.__sync_hook__):
+                await var.__sync_hook__()
+            else:
+                var.__sync_hook__()
+            self._dirty.add(key)
+
+    async def _write_changes(self, write: Callable[[List[Tuple[str, Any]], List[str]],
+                                                   Awaitable[None]]) -> None:
+        """Awaits write(changed, deleted) with the encoded entries to write
+        and the keys to delete since the last sync. The keys are only marked
+        as persisted once the write succeeded, if it fails they're kept as
+        changed for the next sync"""
+        # Keys changed while writing are changed again for the next sync
+        dirty, self._dirty = self._dirty, set()
+        changed = []
+        deleted = []
+        try:
+            for key in dirty:
+                var = self._dict.get(key, None)
+                if key in self._dict and _sync_var(key, var):
+                    changed.append((key, self._encode(key, var)))
+                elif key in self._persisted:
+                    deleted.append(key)
+            if len(changed) > 0 or len(deleted) > 0:
+                await write(changed, deleted)
+        except:
+            self._dirty |= dirty
+            raise
+        self._persisted.update(key for key, _ in changed)
+        self._persisted.difference_update(deleted)
+
+    async def prefetch(self, keys: Iterable[str]) -> None:
+        """Decodes the lazy entries of keys in the executor, so that reading
+        them later doesn't block the event loop. Other keys are ignored"""
+        entries = {key: self._lazy[key] for key in keys if key in self._lazy}
+        if len(entries) == 0:
+            return
+
+        def decode():
+            return [(key, self._decode_lazy(entry)) for key, entry in entries.items()]
+        for key, var in await asyncio.get_event_loop().run_in_executor(None, decode):
+            # Skip entries that were read, set or deleted while decoding
+            if self._lazy.get(key, None) is entries[key]:
+                del self._lazy[key]
+                self._dict[key] = var
+
+    def _encode(self, key, var):
+        return self._dumps(var)
+
+    def _decode_lazy(self, entry):
+        raise NotImplementedError()
+
+    def _dumps(self, var) -> bytes:
+        data = self._serializer.dumps(var)
+        return data.encode('utf-8') if isinstance(data, str) else data
+
+    def _loads(self, data: bytes):
+        return self._serializer.loads(data if self._mode == 'b' else data.decode('utf-8'))
+
+    def __contains__(self, key):
+        return key in self._dict or key in self._lazy
+
+    def __delitem__(self, key):
+        if self._lazy.pop(key, None) is None:
+            del self._dict[key]
+        self._dirty.add(key)
+
+    def __getitem__(self, key):
+        if key in self._lazy:
+            self._dict[key] = self._decode_lazy(self._lazy.pop(key))
+        val = self._dict[key]
+        if not isinstance(val, _IMMUTABLE_TYPES):
+            # Could be changed in place
+            self._dirty.add(key)
+        return val
+
+    def __setitem__(self, key, val):
+        self._lazy.pop(key, None)
+        self._dict[key] = val
+        self._dirty.add(key)
+
+    def __len__(self):
+        return len(self._dict) + len(self._lazy)
+
+    def __iter__(self):
+        if len(self._lazy) == 0:
+            return iter(self._dict)
+        # Reading lazy entries moves them, so iterate over a copy of the keys
+        return iter(list(self._dict) + list(self._lazy))
+
+    def __repr__(self):
+        return repr(self._dict)
+
+    def __str__(self):
+        return str(self._dict)
+
+
+class FileStorage(TrackingStorage):
     """A storage class that behaves like dict, but persists public entries to file
-    Note: private entries start with an _ (underscore)"""
+    Note: private entries start with an _ (underscore)
+
+    With the default load and dump functions the file is an append-only log:
+    sync() only writes the entries that were set, deleted or read (if mutable,
+    since they could have been changed in place) since the last sync, and the
+    log is compacted into a fresh file every compact_every records. Files
+    in the old format, a single serialized dict, are converted on the first
+    sync. With custom load_func or dump_func the whole dict is serialized and
+    dumped on every sync.
+
+    These only apply to the log format:
+    codecs -- a CodecRegistry for choosing how each value is serialized,
+              by default values are serialized with serializer
+    lazy -- memory map the file on load() and only decode values when
+            they're first read. load() then only reads the key index that's
+            written on compaction and the records appended since
+    prefetch -- keys to decode on load() even if lazy, e.g. the keys a script
+                is known to read, see also prefetch()
+    """
     def __init__(self, filename=None, load_func=None, dump_func=None,
-                 serializer=pickle, mode='b'):
+                 serializer=pickle, mode='b', compact_every=1000,
+                 codecs: Optional[CodecRegistry]=None, lazy=False, prefetch: Iterable[str]=()):
+        super().__init__(serializer, mode)
         self.filename = filename
-        self._dict = {}
+        self._codecs = codecs
+        self._lazy_load = lazy
+        self._prefetch = list(prefetch)
         self._load_func = load_func or _load
-        self._dump_func = dump_func or _dump
-        self._serializer = serializer
-        self._mode = mode
+        self._dump_func = dump_func or atomic_write
+        self._incremental = load_func is None and dump_func is None
+        self._compact_every = compact_every
+        # Number of records appended since the file was last compacted,
+        # None means that the file has to be rewritten on the next sync
+        self._appended: Union[int, None] = None
+        self._sync_lock: Union[asyncio.Lock, None] = None
 
     async def load(self):
         """Sync from filename, overwrites exisiting dict entries but doesn't
@@ -52,14 +306,50 @@ class FileStorage(MutableMapping):
         if not self.filename:
             return
 
-        if inspect.iscoroutinefunction(self._load_func):
-            data = await self._load_func(self.filename, self._mode)
-        else:
-            data = await asyncio.get_event_loop().run_in_executor(
-                None, partial(self._load_func, self.filename, self._mode))
+        if not self._incremental:
+            if inspect.iscoroutinefunction(self._load_func):
+                data = await self._load_func(self.filename, self._mode)
+            else:
+                data = await asyncio.get_event_loop().run_in_executor(
+                    None, partial(self._load_func, self.filename, self._mode))
 
-        if data is not None:
-            self._dict.update(self._serializer.loads(data).items())
+            if data is not None:
+                self._dict.update(self._serializer.loads(data).items())
+            return
+
+        read = (partial(_map_file, self.filename) if self._lazy_load else
+                partial(_load, self.filename, 'b'))
+        data = await asyncio.get_event_loop().run_in_executor(None, read)
+        if data is None:
+            return
+
+        if not _is_log(data):
+            # Old format, convert it on the next sync
+            self._dict.update(self._loads(bytes(data)).items())
+            return
+
+        # Only the records appended since the last compaction are read here
+        entries, end = _decode_index(data)
+        appended = 0
+        for op, key, codec, value_data, end in _decode_records(data, end):
+            appended += 1
+            if op == _SET:
+                entries[key] = (codec, value_data)
+            else:
+                entries.pop(key, None)
+
+        for key, entry in entries.items():
+            if self._lazy_load:
+                self._dict.pop(key, None)
+                self._lazy[key] = entry
+            else:
+                self._dict[key] = self._decode_lazy(entry)
+            # The loaded value replaces one set before loading, e.g. a default
+            self._dirty.discard(key)
+        self._persisted = set(entries)
+        # Don't append after a partially written record
+        self._appended = appended if end == len(data) else None
+        await self.prefetch(self._prefetch)
 
     async def sync(self):
         """Sync to filename"""
@@ -67,15 +357,19 @@ class FileStorage(MutableMapping):
             return
 
         # First run any sync hooks on the values
-        for key, var in self._dict.items():
-            if not hasattr(var, '__sync_hook__'):
-                continue
+        await self._run_sync_hooks()
 
-            if inspect.iscoroutinefunction(var.__sync_hook__):
-                await var.__sync_hook__()
+        if self._sync_lock is None:
+            self._sync_lock = asyncio.Lock()
+        async with self._sync_lock:
+            if not self._incremental:
+                await self._dump_all()
+            elif self._appended is None or self._appended >= self._compact_every:
+                await self._compact()
             else:
-                var.__sync_hook__()
+                await self._append_dirty()
 
+    async def _dump_all(self):
         # Remove private variables, functions and classes and any other
         # unserializable object
         sync_vars = {key: var for key, var in self._dict.items() if _sync_var(key, var)}
@@ -88,23 +382,61 @@ class FileStorage(MutableMapping):
             await asyncio.get_event_loop().run_in_executor(
                 None, partial(self._dump_func, self.filename, data, self._mode))
 
-    def __delitem__(self, key):
-        del self._dict[key]
+    async def _compact(self):
+        """Rewrites the file with one record per entry"""
+        dirty, self._dirty = self._dirty, set()
+        try:
+            entries = [(key,) + self._encode(key, var)
+                       for key, var in self._dict.items() if _sync_var(key, var)]
+            # Lazy entries are copied without decoding them
+            entries += [(key, codec, bytes(data)) for key, (codec, data) in self._lazy.items()]
+            await asyncio.get_event_loop().run_in_executor(
+                None, partial(atomic_write, self.filename, _encode_log(entries), 'b'))
+        except:
+            self._dirty |= dirty
+            raise
+        self._persisted = {key for key, _, _ in entries}
+        self._appended = 0
 
-    def __getitem__(self, key):
-        return self._dict[key]
+    async def _append_dirty(self):
+        """Appends records for the entries changed since the last sync"""
+        async def append(changed, deleted):
+            records = ([_encode_record(_SET, key, codec, data) for key, (codec, data) in changed] +
+                       [_encode_record(_DELETE, key) for key in deleted])
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, partial(_append, self.filename, b''.join(records)))
+            except:
+                # The file could end in a partial record, rewrite it next time
+                self._appended = None
+                raise
+            self._appended += len(records)
+        await self._write_changes(append)
 
-    def __setitem__(self, key, val):
-        self._dict[key] = val
+    def _encode(self, key, var) -> Tuple[str, bytes]:
+        """Returns the codec name and serialized value for an entry"""
+        if self._codecs is None:
+            return '', self._dumps(var)
+        return self._codecs.encode(key, var)
 
-    def __len__(self):
-        return len(self._dict)
+    def _decode_lazy(self, entry: Tuple[str, BytesLike]):
+        codec, data = entry
+        if codec == '':
+            return self._loads(bytes(data))
+        # If written with codecs but loaded without, use the built-in ones
+        codecs = self._codecs if self._codecs is not None else _BUILTIN_CODECS
+        return codecs.decode(codec, data)
 
-    def __iter__(self):
-        return iter(self._dict)
 
-    def __repr__(self):
-        return repr(self._dict)
+class ScratchStorage(ChainMap):
+    """A view of a storage where all writes go to a scratch dict on top of it,
+    so that code can run without side effects on the storage until commit()"""
+    def __init__(self, storage: StorageType) -> None:
+        super().__init__({}, storage)
 
-    def __str__(self):
-        return str(self._dict)
+    def commit(self, exclude=()):
+        """Writes the scratch entries, except for keys in exclude, to the storage"""
+        storage = self.maps[1]
+        for key, val in self.maps[0].items():
+            if key not in exclude:
+                storage[key] = val
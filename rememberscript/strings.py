@@ -1,9 +1,11 @@
 import re
+import ast
 import inspect
 import traceback
 import logging
-from types import FunctionType
-from typing import MutableMapping, Any, AsyncIterator, Union, List
+from functools import lru_cache
+from types import FunctionType, CodeType
+from typing import MutableMapping, Any, AsyncIterator, Union, List, Tuple, NamedTuple
 from .storage import StorageType
 
 logger = logging.getLogger('rememberscript')
@@ -20,78 +22,205 @@ def is_str_empty(string: str) -> bool:
 
 esc = lambda x: re.escape(x)
 
-async def execute_string(string: str, storage: StorageType) -> str:
-    """Executes [[ ]] blocks in the string and removes them"""
-    execs = re.compile('%s(.*?)%s' % (esc(EXEC_START), esc(EXEC_END))).findall(string)
-    for ex in execs:
+EXEC_RE = re.compile('%s(.*?)%s' % (esc(EXEC_START), esc(EXEC_END)))
+EVAL_RE = re.compile('%s(.*?)%s' % (esc(EVAL_START), esc(EVAL_END)))
+
+# Maximum number of distinct strings kept in the compiled string cache
+CACHE_SIZE = 4096
+
+
+class Snippet(NamedTuple):
+    """A single {{ }} or [[ ]] code block, its compiled code object and the
+    names it assigns to, i.e. the storage keys it can set"""
+    source: str
+    code: CodeType
+    assigned: Tuple[str, ...]
+
+
+# Nodes with their own scope, names bound in them aren't storage keys
+_FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+_COMPREHENSION_NODES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+def _collect_names(tree: ast.AST, reads: List[str], binds: List[str]) -> None:
+    nodes = [tree]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        inner: List[ast.AST] = []
+        inner_binds: List[str] = []
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            binds.append(node.name)
+            # Decorators, defaults and bases are evaluated in the outer scope
+            nodes.extend(node.decorator_list)
+            if isinstance(node, ast.ClassDef):
+                nodes.extend(node.bases + [keyword.value for keyword in node.keywords])
+            inner.extend(node.body)
+        elif isinstance(node, ast.Lambda):
+            inner.append(node.body)
+        elif isinstance(node, _COMPREHENSION_NODES):
+            inner.extend(ast.iter_child_nodes(node))
+        if isinstance(node, _FUNCTION_NODES):
+            args = node.args
+            nodes.extend(args.defaults + [d for d in args.kw_defaults if d is not None])
+            inner_binds.extend(arg.arg for arg in args.posonlyargs + args.args +
+                               args.kwonlyargs + [args.vararg, args.kwarg] if arg is not None)
+        if len(inner) > 0 or isinstance(node, _FUNCTION_NODES):
+            # Only the names the nested scope reads from outside of it count
+            inner_reads: List[str] = []
+            for child in inner:
+                _collect_names(child, inner_reads, inner_binds)
+            reads.extend(name for name in inner_reads if name not in inner_binds)
+            continue
+
+        if isinstance(node, ast.Name):
+            (reads if isinstance(node.ctx, ast.Load) else binds).append(node.id)
+        elif isinstance(node, ast.alias) and node.name != '*':
+            binds.append((node.asname or node.name).split('.')[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            binds.append(node.name)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            # x += 1 reads x too
+            reads.append(node.target.id)
+        nodes.extend(ast.iter_child_nodes(node))
+
+
+def block_names(tree: ast.AST) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """Returns the names a parsed code block reads and the names it binds
+    (assigns, deletes, imports or defines) in its own scope, i.e. the storage
+    keys it reads and can set. Names bound in nested scopes, e.g. function
+    arguments and comprehension variables, aren't storage keys"""
+    reads: List[str] = []
+    binds: List[str] = []
+    _collect_names(tree, reads, binds)
+    return tuple(dict.fromkeys(reads)), tuple(dict.fromkeys(binds))
+
+
+class CompiledString(NamedTuple):
+    """A trigger or action string split into code blocks and literal text
+
+    execs -- the [[ ]] blocks in order of appearance
+    parts -- the literal strings and {{ }} blocks left after removing execs
+    remainder -- the string with all [[ ]] blocks removed
+    """
+    source: str
+    execs: Tuple[Snippet, ...]
+    parts: Tuple[Union[str, Snippet], ...]
+    remainder: str
+
+
+def _compile_snippet(source: str, mode: str) -> Snippet:
+    try:
+        # Leading spaces and tabs are ignored, like eval() does
+        tree = ast.parse(source.lstrip(' \t'), mode=mode)
+        assert isinstance(tree, (ast.Module, ast.Expression))
+        return Snippet(source, compile(tree, '<string>', mode), block_names(tree)[1])
+    except:
+        block = ('%s%s%s' % (EXEC_START, source, EXEC_END) if mode == 'exec' else
+                 '%s%s%s' % (EVAL_START, source, EVAL_END))
+        logger.error('compile failed "%s"' % block)
+        logger.error(traceback.format_exc())
+        raise
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_string(string: str) -> CompiledString:
+    """Tokenizes a string into literal text, {{ }} and [[ ]] blocks and
+    compiles the code blocks. Results are kept in a bounded LRU cache keyed
+    by the string, see compile_string.cache_info() for hits and misses"""
+    execs = tuple(_compile_snippet(ex, 'exec') for ex in EXEC_RE.findall(string))
+    remainder = EXEC_RE.sub('', string)
+
+    parts: List[Union[str, Snippet]] = []
+    start = 0
+    for m in EVAL_RE.finditer(remainder):
+        if m.start() > start:
+            parts.append(remainder[start:m.start()])
+        parts.append(_compile_snippet(m.group(1), 'eval'))
+        start = m.end()
+    if start < len(remainder):
+        parts.append(remainder[start:])
+
+    return CompiledString(string, execs, tuple(parts), remainder)
+
+
+# Trigger regexes are cached separately from re's own (smaller) cache
+_compile_regex = lru_cache(maxsize=CACHE_SIZE)(re.compile)
+
+
+def _compiled(string: Union[str, CompiledString]) -> CompiledString:
+    return string if isinstance(string, CompiledString) else compile_string(string)
+
+
+async def _run_execs(compiled: CompiledString, storage: StorageType) -> None:
+    for ex in compiled.execs:
         # Exec with session storage to store local variables
         try:
-            exec(ex, {}, storage)
+            exec(ex.code, {}, storage)
         except:
-            logger.error('exec failed "[[%s]]"' % ex)
+            logger.error('exec failed "%s%s%s"' % (EXEC_START, ex.source, EXEC_END))
             logger.error(traceback.format_exc())
             raise
 
-        for key in list(storage.keys()):
-            val = storage[key]
+        # Await coroutines assigned by the block, e.g. [[x = async_func()]]
+        for key in ex.assigned:
+            val = storage.get(key, None)
             if inspect.iscoroutine(val):
                 storage[key] = await val
 
-        # Remove code block
-        exec_block = EXEC_START + ex + EXEC_END
-        start = string.index(exec_block)
-        end = start + len(exec_block)
-        string = string[:start] + string[end:]
-    return string
 
+async def _evaluate_parts(compiled: CompiledString, storage: StorageType) -> AsyncIterator[Any]:
+    for part in compiled.parts:
+        if isinstance(part, str):
+            yield part
+            continue
 
-async def evaluate_split_string(string: str, storage: StorageType) -> AsyncIterator[Any]:
-    """Evaluates {{ }} blocks and yields the string parts and evaluated
-    results in order"""
-    evals = re.compile('%s(.*?)%s' % (esc(EVAL_START), esc(EVAL_END))).findall(string)
-    for ev in evals:
         # Eval with session storage to provide local variables
         try:
-            eval_result = eval(ev, {}, storage)
+            eval_result = eval(part.code, {}, storage)
         except:
-            logger.error('eval failed "{{%s}}"' % ev)
+            logger.error('eval failed "%s%s%s"' % (EVAL_START, part.source, EVAL_END))
             logger.error(traceback.format_exc())
             raise
 
         if inspect.iscoroutine(eval_result):
             eval_result = await eval_result
 
-        # yield the string up to the eval block and the eval result
-        eval_block = EVAL_START + ev + EVAL_END
-        start = string.index(eval_block)
-        end = start + len(eval_block)
-        if start > 0:
-            yield string[:start]
         if eval_result is not None:
             yield eval_result
-        string = string[end:]
 
-    # yield what's left of the string
-    if len(string) > 0:
-        yield string
+
+async def execute_string(string: str, storage: StorageType) -> str:
+    """Executes [[ ]] blocks in the string and removes them"""
+    compiled = compile_string(string)
+    await _run_execs(compiled, storage)
+    return compiled.remainder
+
+
+async def evaluate_split_string(string: str, storage: StorageType) -> AsyncIterator[Any]:
+    """Evaluates {{ }} blocks and yields the string parts and evaluated
+    results in order"""
+    async for part in _evaluate_parts(compile_string(string), storage):
+        yield part
 
 
-async def process_action(string: str, storage: StorageType=None) -> AsyncIterator[Union[str]]:
+async def process_action(string: Union[str, CompiledString],
+                         storage: StorageType=None) -> AsyncIterator[Union[str]]:
     """Processes code blocks in a string and yields results by:
         1. Exec code wrapped in '[[...]]' and remove code from remaining string
         2. Evaluate code wrapped in '{{...}}' and substitute in the 
            original string and yield it/them
 
+    string -- the action, either as a str or as returned by compile_string
     storage -- optional storage used for execs and evals, defaults to {}
     """
     storage = {} if storage is None else storage
-    is_empty_str = is_str_empty(string)
-    string = await execute_string(string, storage)
+    compiled = _compiled(string)
+    is_empty_str = is_str_empty(compiled.source)
+    await _run_execs(compiled, storage)
 
-    if len(string) == 0:
+    if len(compiled.remainder) == 0:
         return
 
-    parts = [part async for part in evaluate_split_string(string, storage)]
+    parts = [part async for part in _evaluate_parts(compiled, storage)]
     if len(parts) == 1:
         part = parts[0]
         if (inspect.isasyncgenfunction(part) or inspect.isgeneratorfunction(part)
@@ -118,10 +247,12 @@ async def process_action(string: str, storage: StorageType=None) -> AsyncIterato
             yield result
 
 
-async def match_trigger(string: str, trigger: str, storage: StorageType=None) -> bool:
+async def match_trigger(string: str, trigger: Union[str, CompiledString],
+                        storage: StorageType=None) -> bool:
     storage = {} if storage is None else storage
-    trigger = await execute_string(trigger, storage)
-    parts = [part async for part in evaluate_split_string(trigger, storage)]
+    compiled = _compiled(trigger)
+    await _run_execs(compiled, storage)
+    parts = [part async for part in _evaluate_parts(compiled, storage)]
     if len(parts) == 1 and isinstance(parts[0], bool):
         return parts[0]
 
@@ -138,8 +269,7 @@ async def match_trigger(string: str, trigger: str, storage: StorageType=None) ->
         else:
             regex_parts.append(str(part))
 
-    
-    regex = re.compile('^%s$' % ''.join(regex_parts))
+    regex = _compile_regex('^%s$' % ''.join(regex_parts))
     m = regex.match(string)
     if m is None:
         return False
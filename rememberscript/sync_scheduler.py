@@ -0,0 +1,128 @@
+"""
+Scheduling of storage syncs, coalesces bursts of sync requests for the same
+storage into a single write and limits the number of concurrent writes
+"""
+import time
+import asyncio
+import logging
+import traceback
+from typing import Dict, Union
+from .storage import StorageType
+
+logger = logging.getLogger('rememberscript')
+
+
+class _PendingSync:
+    __slots__ = ('storage', 'future', 'handle')
+
+    def __init__(self, storage: StorageType, future: asyncio.Future,
+                 handle: asyncio.Handle) -> None:
+        self.storage = storage
+        self.future = future
+        self.handle = handle
+
+
+class SyncScheduler:
+    """Debounces storage syncs: a sync runs delay seconds after it's first
+    requested, and any requests for the same storage until then share it. Since
+    a sync writes the storage as it is when it runs, the latest state wins.
+
+    Syncs of the same storage never overlap, and at most max_writes syncs
+    run at a time. Use flush_all() to write everything before shutting down.
+
+    Metrics:
+    requested -- number of sync requests
+    coalesced -- number of requests that shared an already pending sync
+    written -- number of completed syncs
+    failed -- number of syncs that raised
+    write_time, max_write_time -- total and max time spent in syncs, in seconds
+    """
+    def __init__(self, delay: float=0.1, max_writes: int=4) -> None:
+        self.delay = delay
+        self.max_writes = max_writes
+        self._semaphore: Union[asyncio.Semaphore, None] = None
+        self._pending: Dict[int, _PendingSync] = {}
+        self._running: Dict[int, asyncio.Future] = {}
+        self.requested = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+
+    def schedule(self, storage: StorageType) -> asyncio.Future:
+        """Requests a sync of storage, returns a future that's done when the
+        storage has been synced. Failed syncs are logged (and counted), so
+        the future doesn't need to be awaited"""
+        self.requested += 1
+        key = id(storage)
+        pending = self._pending.get(key, None)
+        if pending is not None:
+            self.coalesced += 1
+            return pending.future
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        # Failures are logged by _write, callers don't have to await the future
+        future.add_done_callback(_retrieve)
+        handle = loop.call_later(self.delay, self._start, key)
+        self._pending[key] = _PendingSync(storage, future, handle)
+        return future
+
+    async def sync(self, storage: StorageType) -> None:
+        """Syncs storage now, together with any pending request for it"""
+        future = self.schedule(storage)
+        self._start(id(storage))
+        await future
+
+    async def flush_all(self) -> None:
+        """Starts all pending syncs now and waits for all syncs to finish"""
+        for key in list(self._pending):
+            self._start(key)
+        while len(self._running) > 0:
+            await asyncio.wait(list(self._running.values()))
+
+    def _start(self, key: int) -> None:
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        pending.handle.cancel()
+
+        task = asyncio.ensure_future(self._write(pending, self._running.get(key, None)))
+        self._running[key] = task
+        def done(task):
+            if self._running.get(key, None) is task:
+                del self._running[key]
+        task.add_done_callback(done)
+
+    async def _write(self, pending: _PendingSync, previous: Union[asyncio.Future, None]) -> None:
+        # Wait for the previous sync of the same storage
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_writes)
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                # Only storages with a sync() method are scheduled
+                await getattr(pending.storage, 'sync')()
+            except Exception as e:
+                self.failed += 1
+                logger.error('sync failed')
+                logger.error(traceback.format_exc())
+                if not pending.future.cancelled():
+                    pending.future.set_exception(e)
+                return
+
+            elapsed = time.perf_counter() - start
+            self.written += 1
+            self.write_time += elapsed
+            self.max_write_time = max(self.max_write_time, elapsed)
+            if not pending.future.cancelled():
+                pending.future.set_result(None)
+
+
+def _retrieve(future: asyncio.Future) -> None:
+    if not future.cancelled():
+        future.exception()
@@ -0,0 +1,4 @@
+async def slow():
+    import asyncio
+    await asyncio.sleep(0.01)
+    return True
@@ -0,0 +1,36 @@
+"""Test the static analysis of code blocks"""
+import math
+from rememberscript.strings import compile_string
+from rememberscript.analysis import code_names, string_names, weight_bound
+
+def test_code_names():
+    usage = code_names('x = y + len(z)', 'exec')
+    assert usage.reads == {'y', 'len', 'z'} and usage.writes == {'x'}
+    usage = code_names('count += 1; del old', 'exec')
+    assert usage.reads == {'count'} and usage.writes == {'count', 'old'}
+    usage = code_names('[w for w in words if w != word]', 'eval')
+    assert usage.reads == {'words', 'word'}
+    usage = code_names('import os.path, random as r\ndef f(a, b=c):\n    return a + d', 'exec')
+    assert usage.reads == {'c', 'd'} and usage.writes == {'os', 'r', 'f'}
+    usage = code_names('lambda x: x + y', 'eval')
+    assert usage.reads == {'y'} and usage.writes == set()
+
+
+def test_string_names():
+    usage = string_names(compile_string('hi {{name}}[[greeted = True]]'))
+    assert usage.reads == {'name'} and usage.writes == {'greeted'}
+
+    usage = string_names(compile_string('my name is (?P<name>\\w+)[[weight = 2]]'),
+                         trigger=True)
+    assert usage.writes == {'weight', 'name', 'match0'}
+
+    # Could be a matching function, which adds a group
+    usage = string_names(compile_string('(\\w+) {{names}}'), trigger=True)
+    assert usage.writes == {'match0', 'match1', 'call0'}
+
+
+def test_weight_bound():
+    for trigger in ['{{obj.f}}', '{{fs[0]}}', '{{f if x else g}}', '{{f or g}}']:
+        assert weight_bound(compile_string(trigger)) == math.inf
+    for trigger in ['{{x == 1}}', '{{not x}}', '{{["a", "b"]}} there[[weight = 2]]']:
+        assert weight_bound(compile_string(trigger)) != math.inf
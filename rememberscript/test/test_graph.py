@@ -0,0 +1,61 @@
+"""Test the analysis of the state graph of a script"""
+import os
+import pytest
+from rememberscript import RememberMachine, load_scripts_dir, validate_script, compile_script
+from rememberscript.graph import build_graph, analyze_script
+from rememberscript.testing import assert_replies
+
+
+async def get_script(name):
+    path = os.path.join(os.path.dirname(__file__), 'scripts/%s/' % name)
+    script = load_scripts_dir(path, {})
+    await validate_script(script)
+    return script
+
+
+@pytest.mark.asyncio
+async def test_analyze_script():
+    script = compile_script(await get_script('script14'))
+    graph = build_graph(script)
+    # Returning from help goes to the return_to of the state that entered it
+    assert graph[('help', 0)] == {('init', 2), ('init', 5)}
+
+    report = analyze_script(script)
+    # orphan is only the target of a duplicate trigger, so the return to
+    # orphan2 never happens either
+    assert report.unreachable == [('init', 4), ('init', 5), ('help', 1)]
+    assert report.noreply_cycles == [[('init', 2), ('init', 3)]]
+    # The second 'hello' and the 'bye' that's lighter than '{{True}}'
+    assert report.dead_triggers == {('init', 0): (1, 3)}
+
+
+@pytest.mark.asyncio
+async def test_prune():
+    raw = await get_script('script2')
+    script = compile_script(raw, prune=True)
+    assert len(script.stories['init'].states[0].triggers) == 1
+    assert len(compile_script(raw).stories['init'].states[0].triggers) == 2
+
+    m = RememberMachine(script, {})
+    m.init()
+    await assert_replies(m.reply(''), 'state2')
+
+
+@pytest.mark.asyncio
+async def test_prune_changed_globals():
+    """Test pruning the unchanged stories again when a global trigger changed"""
+    raw = {'init': [{'name': 'init', '=?>': {'?': 'hi', '=>': 'next', '+': 'hi'}},
+                    {'name': 'done', '=>+': 'done'}],
+           'other': [{'name': 'init', '?': '{{True}}[[weight = 5]]', '=>+': 'other'}]}
+    previous = compile_script(raw, prune=True)
+    assert len(previous.stories['init'].states[0].triggers) == 0
+
+    raw['other'] = [{'name': 'init', '?': 'other', '=>+': 'other'}]
+    script = compile_script(raw, previous, ['other'], prune=True)
+    assert len(script.stories['init'].states[0].triggers) == 1
+    assert script.stories['init'].source is previous.stories['init'].source
+
+    m = RememberMachine(previous, {})
+    m.init()
+    m.reload(script)
+    await assert_replies(m.reply('hi'), 'hi', 'done')
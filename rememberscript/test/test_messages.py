@@ -0,0 +1,40 @@
+"""Test structured replies and the output stages"""
+import json
+import pytest
+import asyncio
+from rememberscript.messages import Message, encode, buffered
+
+def test_message():
+    extra = {'buttons': ['yes', 'no']}
+    message = Message(42, extra, 0.0)
+    assert message.to_dict() == {'content': '42', 'buttons': ['yes', 'no']}
+    assert message.latency >= 0.0
+
+    content = {'image': 'cat.png'}
+    assert Message(content, {}, 0.0).to_dict() is content
+    assert json.loads(encode(Message(content, extra, 0.0))) == dict(content, **extra)
+    assert content == {'image': 'cat.png'}
+
+
+@pytest.mark.asyncio
+async def test_buffered():
+    produced = []
+    async def replies():
+        for i in range(10):
+            produced.append(i)
+            yield i
+        raise ValueError('done')
+
+    stream = buffered(replies(), maxsize=3)
+    assert await stream.__anext__() == 0
+    await asyncio.sleep(0.01)
+    # The producer runs ahead until the queue is full
+    assert len(produced) == 5
+
+    assert [i async for i in _until_error(stream)] == list(range(1, 10))
+
+
+async def _until_error(stream):
+    with pytest.raises(ValueError):
+        async for i in stream:
+            yield i
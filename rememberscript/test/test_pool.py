@@ -0,0 +1,255 @@
+"""Test the MachinePool class"""
+import os
+import pytest
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from rememberscript import MachinePool, FileStorage, SyncScheduler
+from rememberscript.testing import assert_replies
+import rememberscript.script as script_module
+
+def script_path(name):
+    return os.path.join(os.path.dirname(__file__), 'scripts/%s/' % name)
+
+
+@pytest.mark.asyncio
+async def test_sessions():
+    """Test that sessions share the script but not the storage"""
+    pool = await MachinePool.load(script_path('script1'))
+
+    await assert_replies(pool.reply('a', ''), 'Welcome!', 'Set a username:')
+    await assert_replies(pool.reply('b', ''), 'Welcome!', 'Set a username:')
+    await assert_replies(pool.reply('a', 'user'), 'Thanks, we\'re all set up', 'Lets study')
+    await assert_replies(pool.reply('b', 'other'), 'Thanks, we\'re all set up', 'Lets study')
+    assert pool._active['a']._storage['username'] == 'user'
+    assert pool._active['b']._storage['username'] == 'other'
+    assert pool._active['a']._script is pool._active['b']._script
+
+
+@pytest.mark.asyncio
+async def test_park(tmpdir):
+    """Test parking idle sessions with persistent storage"""
+    factory = lambda session_id: FileStorage(str(tmpdir.join('%s.bin' % session_id)))
+    pool = await MachinePool.load(script_path('script1'), storage_factory=factory,
+                                  max_active=1)
+
+    await assert_replies(pool.reply('a', ''), 'Welcome!', 'Set a username:')
+    await assert_replies(pool.reply('b', ''), 'Welcome!', 'Set a username:')
+    assert pool.active_count == 1 and len(pool) == 2
+    assert pool._parked['a'].storage is None
+    assert tmpdir.join('a.bin').exists()
+
+    # Session a continues where it was, with its storage loaded from file
+    await assert_replies(pool.reply('a', 'user'), 'Thanks, we\'re all set up', 'Lets study')
+    assert pool._active['a']._storage['username'] == 'user'
+
+    await pool.close()
+    assert pool.active_count == 0 and len(pool) == 2
+
+
+
+@pytest.mark.asyncio
+async def test_restart(tmpdir):
+    """Test continuing a session with a new pool"""
+    factory = lambda session_id: FileStorage(str(tmpdir.join('%s.bin' % session_id)))
+    pool = await MachinePool.load(script_path('script1'), storage_factory=factory)
+    await assert_replies(pool.reply('a', ''), 'Welcome!', 'Set a username:')
+    await pool.close()
+
+    pool = await MachinePool.load(script_path('script1'), storage_factory=factory)
+    await assert_replies(pool.reply('a', 'user'), 'Thanks, we\'re all set up', 'Lets study')
+
+
+@pytest.mark.asyncio
+async def test_sync_scheduler(tmpdir):
+    """Test syncing storages through a scheduler after replies"""
+    factory = lambda session_id: FileStorage(str(tmpdir.join('%s.bin' % session_id)))
+    scheduler = SyncScheduler(delay=10)
+    pool = await MachinePool.load(script_path('script1'), storage_factory=factory,
+                                  sync_scheduler=scheduler)
+    await assert_replies(pool.reply('a', ''), 'Welcome!', 'Set a username:')
+    await assert_replies(pool.reply('a', 'user'), 'Thanks, we\'re all set up', 'Lets study')
+    assert not tmpdir.join('a.bin').exists()
+
+    await scheduler.flush_all()
+    assert tmpdir.join('a.bin').exists()
+    assert scheduler.requested == 2 and scheduler.written == 1
+
+
+@pytest.mark.asyncio
+async def test_dispatcher():
+    """Test that the messages of a session are processed in order"""
+    pool = await MachinePool.load(script_path('script13'), executor=ThreadPoolExecutor(2))
+
+    async def send(session_id, msg):
+        return [m.content async for m in pool.replies(session_id, msg)]
+
+    replies = await asyncio.gather(*[send(session_id, '%s%i' % (session_id, i))
+                                     for i in range(3) for session_id in 'ab'])
+    assert replies == [['a0'], ['b0'], ['a1'], ['b1'], ['a2'], ['b2']]
+
+    stats = pool.dispatcher.stats('a')
+    assert stats.processed == 3 and stats.depth == 0 and stats.max_wait_time >= 0.01
+    assert pool.dispatcher.depth == 0
+
+    # Parked sessions don't keep their stats
+    await pool.park('a')
+    assert pool.dispatcher.stats('a').processed == 0
+    assert list(pool.dispatcher._stats) == ['b']
+
+
+STORY = '''- name: init
+  =?>:
+    - ?: go
+      =>: %s
+%s- name: waiting
+  =>+: "waiting"
+  =?>:
+    - ?: next
+      =>: done
+- name: done
+  =>+: "%s"
+'''
+
+@pytest.mark.asyncio
+async def test_reload(tmpdir):
+    """Test swapping in changed stories with sessions in progress"""
+    scripts = tmpdir.mkdir('scripts')
+    scripts.join('init.yaml').write(STORY % ('waiting', '', 'done'))
+    scripts.join('other.yaml').write('- name: init\n  ?: other\n  =>+: "other"\n')
+    pool = await MachinePool.load(str(scripts), max_active=2)
+    for session_id in 'abc':
+        await assert_replies(pool.reply(session_id, 'go'), 'waiting')
+    assert 'a' in pool._parked
+    other = pool._script.stories['other']
+
+    # A new state before waiting, and a new reply in done
+    scripts.join('init.yaml').write(STORY % ('waiting', '- name: new\n', 'done again'))
+    assert await pool.reload(str(scripts)) == ['init']
+    assert pool._script.stories['other'] is other
+    await assert_replies(pool.reply('a', 'next'), 'done again')
+    await assert_replies(pool.reply('b', 'next'), 'done again')
+
+    # Sessions in a state that was removed start over in init
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: go\n      =>: done\n'
+                                    '- name: done\n  =>+: "done"\n')
+    assert await pool.reload(str(scripts)) == ['init']
+    await assert_replies(pool.reply('c', 'go'), 'done')
+    assert await pool.reload(str(scripts)) == []
+
+
+@pytest.mark.asyncio
+async def test_reload_sources(tmpdir):
+    """Test reloading changed .py files and pools built from a compiled script"""
+    scripts = tmpdir.mkdir('scripts')
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: hey\n'
+                                    '      =>: loopback\n      +: "{{greet()}}"\n')
+    scripts.join('init.py').write('def greet():\n    return "hi"\n')
+    scripts.join('other.yaml').write('- name: init\n  ?: other\n  =>+: "other"\n')
+    pool = await MachinePool.load(str(scripts), max_active=1)
+    for session_id in 'ab':
+        await assert_replies(pool.reply(session_id, 'hey'), 'hi')
+    assert 'a' in pool._parked
+
+    # Parked sessions that kept their storage get the new functions too
+    scripts.join('init.py').write('def greet():\n    return "hello"\n')
+    assert await pool.reload(str(scripts)) == ['init']
+    for session_id in 'ab':
+        await assert_replies(pool.reply(session_id, 'hey'), 'hello')
+
+    # References to other stories are checked even if they didn't change
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: go\n      =>: other\n')
+    scripts.join('other.yaml').write('- name: init\n  =>+: "other"\n')
+    assert await pool.reload(str(scripts)) == ['init', 'other']
+    scripts.join('other.yaml').remove()
+    with pytest.raises(AssertionError):
+        await pool.reload(str(scripts))
+
+    compiled = MachinePool(pool._script, pool._defaults)
+    scripts.join('other.yaml').write('- name: init\n  =>+: "other"\n')
+    assert await compiled.reload(str(scripts)) == []
+
+
+@pytest.mark.asyncio
+async def test_load_undefined_names(tmpdir):
+    """Test that loading and reloading check the names against the .py files"""
+    scripts = tmpdir.mkdir('scripts')
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: hey\n'
+                                    '      =>: loopback\n      +: "{{greet()}}"\n')
+    with pytest.raises(AssertionError, match='greet'):
+        await MachinePool.load(str(scripts))
+
+    scripts.join('init.py').write('def greet():\n    return "hi"\n')
+    pool = await MachinePool.load(str(scripts))
+    scripts.join('init.py').remove()
+    with pytest.raises(AssertionError, match='greet'):
+        await pool.reload(str(scripts))
+    await assert_replies(pool.reply('a', 'hey'), 'hi')
+
+
+@pytest.mark.asyncio
+async def test_watch(tmpdir, monkeypatch):
+    """Test that only changed files are parsed and changes are found by content"""
+    parsed = []
+    parse = script_module._parse_yaml_files
+    monkeypatch.setattr(script_module, '_parse_yaml_files',
+                        lambda data, workers: parsed.append(len(data)) or parse(data, workers))
+    scripts = tmpdir.mkdir('scripts')
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: hey\n'
+                                    '      =>: loopback\n      +: "before"\n')
+    scripts.join('other.yaml').write('- name: init\n  ?: other\n  =>+: "other"\n')
+    pool = await MachinePool.load(str(scripts))
+    watching = asyncio.ensure_future(pool.watch(str(scripts), interval=0.01))
+    await asyncio.sleep(0.05)
+
+    # Same size and mtime
+    path = str(scripts.join('init.yaml'))
+    stat = os.stat(path)
+    scripts.join('init.yaml').write('- name: init\n  =?>:\n    - ?: hey\n'
+                                    '      =>: loopback\n      +: "after!"\n')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if parsed == [2, 1]:
+            break
+    watching.cancel()
+    assert parsed == [2, 1]
+    await assert_replies(pool.reply('a', 'hey'), 'after!')
+
+
+@pytest.mark.asyncio
+async def test_noreply_stats():
+    """Test counting the noreply states of each session"""
+    pool = await MachinePool.load(script_path('script14'), max_noreply=3)
+    await assert_replies(pool.reply('a', 'hey'))
+    await assert_replies(pool.reply('a', 'hey'))
+    stats = pool.dispatcher.stats('a')
+    assert stats.noreply_hops == 6 and stats.max_noreply_chain == 3
+
+
+class SlowStorage(dict):
+    """A storage kept in a dict of saved storages, the first load is slow"""
+    def __init__(self, saved, session_id):
+        self.saved = saved
+        self.session_id = session_id
+
+    async def load(self):
+        await asyncio.sleep(0.01 if len(self.saved['loads']) == 0 else 0)
+        self.saved['loads'].append(self.session_id)
+        self.update(self.saved.get(self.session_id, {}))
+
+    async def sync(self):
+        self.saved[self.session_id] = dict(self)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_load():
+    """Test getting a parked session again while its storage loads"""
+    saved = {'loads': []}
+    pool = await MachinePool.load(script_path('script1'),
+                                  storage_factory=lambda i: SlowStorage(saved, i))
+    await assert_replies(pool.reply('a', ''), 'Welcome!', 'Set a username:')
+    await pool.close()
+
+    saved['loads'] = []
+    a, b = await asyncio.gather(pool._get_machine('a'), pool._get_machine('a'))
+    assert a is b and a.curr_position == 1 and len(saved['loads']) == 1
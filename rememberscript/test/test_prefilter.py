@@ -0,0 +1,35 @@
+"""Test the trigger prefilter"""
+from rememberscript.strings import compile_string
+from rememberscript.prefilter import TriggerPrefilter, is_static
+
+def test_is_static():
+    assert is_static(compile_string('hello world'))
+    assert is_static(compile_string('hello (\\w+)[[weight = 2]]'))
+    assert not is_static(compile_string('hello {{words}}'))
+
+
+def test_candidates():
+    triggers = [compile_string(t) for t in [
+        'hello', '{{True}}', 'hello|hi', 'bye', '(?P<name>\\w+) here', 'h.*',
+        'hello']]
+    prefilter = TriggerPrefilter(triggers)
+    assert prefilter.candidates('hello') == [0, 1, 2, 5, 6]
+    assert prefilter.candidates('hello\n') == [0, 1, 2, 5, 6]
+    assert prefilter.candidates('bye') == [1, 3]
+    assert prefilter.candidates('me here') == [1, 4]
+    assert prefilter.candidates('nothing') == [1]
+
+    # '^hi|bye$' matches anything starting with hi, as in match_trigger
+    prefilter = TriggerPrefilter([compile_string('hi|bye'), compile_string('x+')])
+    assert prefilter.candidates('hiya') == [0]
+    assert prefilter.candidates('bye') == [0]
+    assert prefilter.candidates('goodbye') == []
+    assert prefilter.candidates('xx') == [1]
+
+
+def test_weight_bounds():
+    triggers = [compile_string(t) for t in [
+        'hello', '{{True}}[[weight = 0]]', 'hello[[weight = 2]]', '{{words}}']]
+    prefilter = TriggerPrefilter(triggers)
+    assert prefilter.bounds == (1.0, 0.0, 2.0, float('inf'))
+    assert prefilter.candidates('hello') == [3, 2, 0, 1]
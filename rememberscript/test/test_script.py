@@ -1,13 +1,19 @@
 """Test the RememberMachine class"""
 import pytest
 import os
-from rememberscript import RememberMachine, load_scripts_dir, validate_script
+import asyncio
+from rememberscript import RememberMachine, load_scripts_dir, validate_script, compile_script
 from rememberscript.testing import assert_replies
+import rememberscript.script as script_module
 
-async def get_machine(name):
+def get_script(name, storage):
     path = os.path.join(os.path.dirname(__file__), 'scripts/%s/' % name)
+    return load_scripts_dir(path, storage)
+
+
+async def get_machine(name):
     storage = {}
-    script = load_scripts_dir(path, storage)
+    script = get_script(name, storage)
     await validate_script(script)
     m = RememberMachine(script, storage)
     m.init()
@@ -27,6 +33,16 @@ async def test_bot1():
     assert m._storage['username'] == 'user'
 
 
+@pytest.mark.asyncio
+async def test_replies():
+    """Test the structured replies"""
+    m = await get_machine('script1')
+    replies = [reply async for reply in m.replies('')]
+    assert [reply.content for reply in replies] == ['Welcome!', 'Set a username:']
+    assert all(reply.created >= reply.received for reply in replies)
+    await assert_replies(m.replies('user'), 'Thanks, we\'re all set up', 'Lets study')
+
+
 @pytest.mark.asyncio
 async def test_weight():
     """Test trigger weights"""
@@ -75,3 +91,220 @@ async def test_should_trigger():
     with pytest.raises(AssertionError):
         storage = {}
         m = await get_machine('script7')
+
+
+def test_compile_script():
+    """Test the compiled form of a script"""
+    compiled = compile_script(get_script('script4', {}))
+    assert set(compiled.story_names) == {'init', 'other'}
+    init = compiled.stories['init']
+    assert init.state_index['foo'] == 1 and init.states[1].name == 'foo'
+    assert [t.to for _, t in init.states[0].triggers] == ['other', 'foo']
+    assert init.states[0].triggers[1][1].actions[0].source == 'going to foo'
+
+    # The default trigger is used for transitions without triggers
+    trigger, transition = compiled.stories['other'].states[0].triggers[0]
+    assert trigger.source == '{{True}}[[weight = 0]]' and transition.to == 'return'
+    assert compiled.global_triggers == ()
+
+
+@pytest.mark.asyncio
+async def test_identical_states():
+    """Test going to next from one of several identical states"""
+    m = await get_machine('script8')
+
+    await assert_replies(m.reply(''), 'same')
+    await assert_replies(m.reply(''), 'same')
+    await assert_replies(m.reply(''), 'last')
+    assert m.curr_position == 3
+
+
+@pytest.mark.asyncio
+async def test_weight_bound():
+    """Test that triggers that can't beat the max weight aren't evaluated"""
+    m = await get_machine('script9')
+
+    # Evaluating the first trigger would raise a NameError
+    await assert_replies(m.reply(''), 'state2')
+
+
+@pytest.mark.asyncio
+async def test_names():
+    """Test the storage keys recorded per state and the undefined name check"""
+    storage = {}
+    script = get_script('script1', storage)
+    await validate_script(script, storage)
+    compiled = compile_script(script)
+    names = set().union(*(state.names.writes for state in compiled.stories['init'].states))
+    assert 'username' in names
+
+    storage = {}
+    script = get_script('script9', storage)
+    with pytest.raises(AssertionError, match='undefined_name'):
+        await validate_script(script, storage)
+
+    # Imports and functions defined in blocks are defined names
+    script = {'init': [{'name': 'init', '=>+': ['[[import random]]', '[[def f(a): return a]]',
+                                                 '{{f(random.random())}}']}]}
+    await validate_script(script, {})
+
+
+@pytest.mark.asyncio
+async def test_validate_script():
+    """Test the reference check and skipping transitions that already passed"""
+    script = {'init': [{'name': 'init', '=?>': {'=>': 'missing'}}]}
+    with pytest.raises(AssertionError, match='missing'):
+        await validate_script(script)
+    script['other'] = [{'name': 'init', '=?>': {'=>': 'return', 'return=>': 'gone'}}]
+    script['init'][0]['=?>']['=>'] = 'other'
+    with pytest.raises(AssertionError, match='gone'):
+        await validate_script(script)
+
+    script['other'][0]['=?>']['return=>'] = 'init'
+    transition = {'?': 'hi', 'should_trigger': 'hi', 'should_not_trigger': 'bye'}
+    script['init'].append({'name': 'state2', '=?>': transition})
+    validated = {}
+    await validate_script(script, validated=validated)
+    assert list(validated) == [script_module._transition_hash(transition)]
+
+    transition['should_trigger'] = 'bye'
+    with pytest.raises(AssertionError, match='bye'):
+        await validate_script(script, validated=validated)
+
+
+@pytest.mark.asyncio
+async def test_validate_cancel(monkeypatch):
+    """Test that the other stories stop validating when one fails"""
+    cancelled = []
+    async def validate_story(story, states, validated):
+        if story == 'init':
+            raise AssertionError('invalid')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(story)
+            raise
+    monkeypatch.setattr(script_module, '_validate_story', validate_story)
+    script = {'other': [{'name': 'init'}], 'init': [{'name': 'init'}]}
+    with pytest.raises(AssertionError, match='invalid'):
+        await validate_script(script)
+    await asyncio.sleep(0)
+    assert cancelled == ['other']
+
+
+@pytest.mark.asyncio
+async def test_concurrent_triggers():
+    """Test evaluating async matching functions concurrently"""
+    running = [0, 0]
+    async def slow_match(string, storage):
+        running[0] += 1
+        running[1] = max(running)
+        weight = storage['weight']
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        # Other triggers don't see this trigger's weight
+        return storage['weight'] == weight
+
+    storage = {'slow_match': slow_match}
+    m = RememberMachine(get_script('script10', storage), storage, concurrency=2)
+    m.init()
+
+    await assert_replies(m.reply('hello'), 'state3 hello')
+    assert running[1] == 2
+    assert 'weight' not in storage
+
+
+@pytest.mark.asyncio
+async def test_trigger_side_effects():
+    """Test that only the winning trigger writes to storage"""
+    m = await get_machine('script11')
+
+    await assert_replies(m.reply('hello'), 'state2 hello')
+    assert m._storage['winner'] == 'hello' and m._storage['match0'] == 'hello'
+    for key in ['loser', 'lost', 'weight']:
+        assert key not in m._storage
+
+
+@pytest.mark.asyncio
+async def test_snapshot():
+    """Test suspending and resuming a machine"""
+    m = await get_machine('script4')
+    await assert_replies(m.reply(''), 'in other')
+    snapshot = m.snapshot()
+    assert m.position == ('other', 0, None, ((None, -1, None), ('init', 0, None)))
+
+    m2 = RememberMachine(m._script, m._storage)
+    m2.restore(snapshot)
+    assert m2.position == m.position
+    await assert_replies(m2.reply(''), 'in init')
+
+    for unsupported in [b'[0,0,0,null,[]]', b'[1,1,0,null,[[-1,-1,null]]]']:
+        with pytest.raises(ValueError):
+            m2.restore(unsupported)
+
+    # States are found by name after stories and states were added
+    init = [{'name': 'init', '=?>': {'=>': 'other'}}]
+    other = [{'name': 'init', '=>+': 'in other'}, {'name': 'two', '=>+': 'two'}]
+    m = RememberMachine({'init': init, 'other': other})
+    m.init()
+    await assert_replies(m.reply(''), 'in other')
+    await assert_replies(m.reply(''), 'two')
+    other = other[:1] + [{'name': 'added'}] + other[1:]
+    m2 = RememberMachine({'init': init, 'new': [{'name': 'init'}], 'other': other})
+    m2.restore(m.snapshot())
+    assert m2.position == ('other', 2, None, ((None, -1, None), ('init', 0, None)))
+
+    # Snapshots with stories or states that don't exist start over
+    m2.restore(b'[2,"gone",5,null,[[null,-1,null],["init",0,null]]]')
+    assert m2.position == ('init', 0, None, ((None, -1, None),))
+    m2.restore(b'[2,"other","removed",null,[[null,-1,null],["init",0,null]]]')
+    assert m2.position == ('init', 0, None, ((None, -1, None),))
+
+
+def test_load_scripts_cache(tmpdir, monkeypatch):
+    """Test that cached stories are only parsed again when changed"""
+    parsed = []
+    parse = script_module._parse_yaml_files
+    monkeypatch.setattr(script_module, '_parse_yaml_files',
+                        lambda data, workers: parsed.append(len(data)) or parse(data, workers))
+    scripts = tmpdir.mkdir('scripts')
+    for name in ['init', 'other']:
+        scripts.join(name + '.yaml').write('- name: init\n  =>+: "in %s"\n' % name)
+    cache_path = str(tmpdir.join('cache'))
+    script = load_scripts_dir(str(scripts), {}, cache_path)
+    assert script['other'] == [{'name': 'init', '=>+': 'in other'}]
+
+    scripts.join('other.yaml').write('- name: init\n  =>+: "changed"\n')
+    cached = load_scripts_dir(str(scripts), {}, cache_path)
+    assert cached['init'] == script['init'] and cached['other'][0]['=>+'] == 'changed'
+    assert parsed == [2, 1]
+
+    # Parsing in worker processes gives the same result
+    assert load_scripts_dir(str(scripts), {}, workers=2) == cached
+
+    # Changes are found by content, even with the same size and mtime
+    stat = os.stat(str(scripts.join('other.yaml')))
+    scripts.join('other.yaml').write('- name: init\n  =>+: "CHANGED"\n')
+    os.utime(str(scripts.join('other.yaml')), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert load_scripts_dir(str(scripts), {}, cache_path)['other'][0]['=>+'] == 'CHANGED'
+    assert parsed == [2, 1, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_noreply_chain():
+    """Test long chains and cycles of noreply states"""
+    states = [{'name': 'init', '=?>': {'?': 'go', '=>': 'state0'}}]
+    for i in range(2000):
+        states.append({'name': 'state%i' % i, '=>+': 'state%i' % i, 'noreply': True})
+    states.append({'name': 'end', '=>+': 'end'})
+    m = RememberMachine({'init': states})
+    m.init()
+    replies = [r async for r in m.replies('go')]
+    assert len(replies) == 2001 and replies[-1].content == 'end'
+    assert m.noreply_chain == 2000
+
+    # noreply1 and noreply2 go to each other forever
+    m = RememberMachine(get_script('script14', {}), max_noreply=5)
+    m.init()
+    await assert_replies(m.reply('hey'))
+    assert m.noreply_chain == 5 and m.curr_state.name == 'noreply2'
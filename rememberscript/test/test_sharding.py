@@ -0,0 +1,45 @@
+"""Test running sessions in worker processes"""
+import os
+import asyncio
+import pytest
+from rememberscript import FileStorage
+from rememberscript.sharding import ShardedPool, shard
+from rememberscript.testing import assert_replies
+
+def script_path(name):
+    return os.path.join(os.path.dirname(__file__), 'scripts/%s/' % name)
+
+
+def test_sharded_pool(tmpdir):
+    """Test a simulated load of many concurrent sessions on two workers"""
+    factory = lambda session_id: FileStorage(str(tmpdir.join('%s.bin' % session_id)))
+    pool = ShardedPool(script_path('script1'), workers=2, storage_factory=factory)
+    # The workers are forked before the event loop runs
+    pool.start()
+
+    async def session(i):
+        await assert_replies(pool.reply('s%i' % i, ''), 'Welcome!', 'Set a username:')
+        await assert_replies(pool.replies('s%i' % i, 'user%i' % i),
+                             'Thanks, we\'re all set up', 'Lets study')
+
+    async def run():
+        sessions = range(100)
+        await asyncio.gather(*[session(i) for i in sessions])
+        assert {shard('s%i' % i, 2) for i in sessions} == {0, 1}
+        pids = {worker.process.pid for worker in pool._workers}
+        await pool.close()
+        assert len(pids) == 2 and os.getpid() not in pids
+
+        # The workers synced the storages of their sessions on close
+        storage = FileStorage(str(tmpdir.join('s42.bin')))
+        await storage.load()
+        assert storage['username'] == 'user42'
+
+    asyncio.run(run())
+
+
+@pytest.mark.asyncio
+async def test_start_in_loop():
+    """Test that workers aren't forked from a running event loop"""
+    with pytest.raises(RuntimeError):
+        ShardedPool(script_path('script1'), workers=1).start()
@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+from rememberscript.sqlite_storage import SQLiteDatabase, SQLiteStorage
+
+@pytest.mark.asyncio
+async def test_sqlitestorage(tmpdir):
+    filename = str(tmpdir.join('test.db'))
+    database = SQLiteDatabase(filename)
+    batches = []
+    write_batch = database._write_batch
+    database._write_batch = lambda writes: batches.append(writes) or write_batch(writes)
+
+    storages = [SQLiteStorage(database, 'session%i' % i) for i in range(10)]
+    for i, storage in enumerate(storages):
+        storage['hello'] = i
+        storage['history'] = [i]
+        storage['_private'] = i
+        storage['fun'] = lambda: None
+
+    # Syncs during the same event loop iteration are committed together
+    await asyncio.gather(*(storage.sync() for storage in storages))
+    assert len(batches) == 1 and len(batches[0]) == 10
+
+    storages[0]['history'].append(1)
+    del storages[0]['hello']
+    await storages[0].sync()
+    session, changed, deleted = batches[-1][0]
+    assert session == 'session0' and deleted == ['hello']
+    assert [key for key, _ in changed] == ['history']
+    await database.close()
+
+    database = SQLiteDatabase(filename)
+    storage = SQLiteStorage(database, 'session0')
+    await storage.load()
+    assert dict(storage) == {'history': [0, 1]}
+
+    storage = SQLiteStorage(database, 'session1')
+    await storage.load(['hello'])
+    assert dict(storage) == {'hello': 1}
+    await database.close()
+
+
+@pytest.mark.asyncio
+async def test_cancelled_flush(tmpdir):
+    """Test that writes are cancelled when their batch is cancelled"""
+    database = SQLiteDatabase(str(tmpdir.join('test.db')))
+    async def run(func, *args):
+        raise asyncio.CancelledError()
+    database._run = run
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(database.write('a', [('key', b'value')], []), 1)
@@ -1,6 +1,9 @@
 import os
+import pickle
 import pytest
 from rememberscript.storage import FileStorage
+import rememberscript.storage as storage_module
+from rememberscript.serializers import CodecRegistry
 
 @pytest.mark.asyncio
 async def test_filestorage():
@@ -28,3 +31,168 @@ async def test_filestorage():
     assert 'TestClass' not in storage
     assert 'pytest' not in storage
     os.remove(filename)
+
+
+@pytest.mark.asyncio
+async def test_filestorage_incremental(tmpdir):
+    filename = str(tmpdir.join('test.bin'))
+    storage = FileStorage(filename, compact_every=3)
+    for i in range(100):
+        storage['key%i' % i] = i
+    storage['history'] = []
+    await storage.sync()
+    size = os.path.getsize(filename)
+
+    # Only changed entries and mutable entries that were read are written
+    storage['key0'] = 'changed'
+    storage['history'].append(1)
+    del storage['key1']
+    storage['_private'] = 1
+    await storage.sync()
+    assert size < os.path.getsize(filename) < size + 100
+
+    loaded = FileStorage(filename)
+    await loaded.load()
+    assert loaded['key0'] == 'changed' and loaded['history'] == [1]
+    assert 'key1' not in loaded and len(loaded) == 100
+
+    # The log is compacted after compact_every records
+    storage['key2'] = 'changed'
+    await storage.sync()
+    assert storage._appended == 0
+    storage['key3'] = 'changed'
+    await storage.sync()
+    assert storage._appended == 1
+
+    loaded = FileStorage(filename)
+    await loaded.load()
+    assert loaded['key2'] == 'changed' and loaded['key3'] == 'changed'
+    assert 'key1' not in loaded and len(loaded) == 100
+
+
+@pytest.mark.asyncio
+async def test_filestorage_old_format(tmpdir):
+    filename = str(tmpdir.join('test.bin'))
+    with open(filename, 'wb') as f:
+        f.write(pickle.dumps({'hello': 3}))
+
+    storage = FileStorage(filename)
+    await storage.load()
+    assert storage['hello'] == 3
+    storage['world'] = 4
+    await storage.sync()
+
+    storage = FileStorage(filename)
+    await storage.load()
+    assert storage['hello'] == 3 and storage['world'] == 4
+
+
+@pytest.mark.asyncio
+async def test_filestorage_codecs(tmpdir):
+    filename = str(tmpdir.join('test.bin'))
+    codecs = CodecRegistry()
+    codecs.use_for_type(list, 'array')
+    codecs.use_for_key('settings', 'json')
+    storage = FileStorage(filename, codecs=codecs)
+    storage['scores'] = [0.5, 1.0, 2.5]
+    storage['ids'] = list(range(1000))
+    storage['mixed'] = [1, 'a']
+    storage['settings'] = {'a': [1, 2]}
+    storage['data'] = bytearray(b'x' * 100)
+    await storage.sync()
+    storage['ids'].append(1000)
+    await storage.sync()
+
+    # Values are only decoded when read
+    storage = FileStorage(filename, lazy=True)
+    await storage.load()
+    assert len(storage) == 5 and 'ids' in storage and len(storage._dict) == 0
+    assert storage['ids'] == list(range(1001))
+    assert len(storage._dict) == 1
+    assert storage['scores'] == [0.5, 1.0, 2.5] and storage['mixed'] == [1, 'a']
+    assert storage['settings'] == {'a': [1, 2]}
+    assert storage['data'] == bytearray(b'x' * 100)
+
+    # Compaction keeps entries that were never decoded
+    storage = FileStorage(filename, lazy=True, compact_every=0)
+    await storage.load()
+    storage['new'] = 1
+    await storage.sync()
+    storage = FileStorage(filename)
+    await storage.load()
+    assert storage['ids'] == list(range(1001)) and storage['new'] == 1
+
+    # Defaults set before loading don't delete the persisted values
+    for lazy in [True, False]:
+        storage = FileStorage(filename, lazy=lazy)
+        storage['new'] = 0
+        await storage.load()
+        await storage.sync()
+        storage = FileStorage(filename)
+        await storage.load()
+        assert storage['new'] == 1
+
+
+@pytest.mark.asyncio
+async def test_filestorage_index(tmpdir):
+    filename = str(tmpdir.join('test.bin'))
+    storage = FileStorage(filename)
+    for i in range(100):
+        storage['key%d' % i] = [i]
+    await storage.sync()
+    storage['key1'] = 'changed'
+    del storage['key2']
+    await storage.sync()
+
+    # The compacted entries come from the index, the rest from the appended records
+    storage = FileStorage(filename, lazy=True, prefetch=['key3', 'missing'])
+    await storage.load()
+    assert len(storage) == 99 and 'key2' not in storage
+    assert list(storage._dict) == ['key3'] and storage._appended == 2
+    assert storage['key1'] == 'changed' and storage['key99'] == [99]
+
+    await storage.prefetch(['key50', 'key51'])
+    assert set(storage._dict) == {'key1', 'key3', 'key50', 'key51', 'key99'}
+    assert storage['key50'] == [50]
+
+
+@pytest.mark.asyncio
+async def test_filestorage_failed_sync(tmpdir, monkeypatch):
+    """Test that changes are written by the next sync when a sync fails"""
+    filename = str(tmpdir.join('test.bin'))
+    storage = FileStorage(filename)
+    storage['a'] = 1
+    await storage.sync()
+
+    def fail(filename, data):
+        raise OSError('disk full')
+    with monkeypatch.context() as m:
+        m.setattr(storage_module, '_append', fail)
+        storage['b'] = 2
+        with pytest.raises(OSError):
+            await storage.sync()
+    await storage.sync()
+
+    storage = FileStorage(filename)
+    await storage.load()
+    assert dict(storage) == {'a': 1, 'b': 2}
+
+
+def test_codecs():
+    codecs = CodecRegistry()
+    for name in ['pickle', 'marshal', 'json', 'array']:
+        codec = codecs[name]
+        assert codec.decode(codec.encode([1, 2, 3])) == [1, 2, 3]
+    # json only encodes values that decode unchanged
+    codecs.use_for_key('value', 'json')
+    shared = [1]
+    for value in [(1, 2), {1: 'a'}, {'a': [(1,)]}, [shared, shared], {1, 2}]:
+        assert codecs.encode('value', value)[0] == 'pickle'
+    assert codecs.encode('value', {'a': [1, None, 'b']})[0] == 'json'
+    assert codecs.decode('pickle', codecs['pickle'].encode(bytearray(b'abc'))) == b'abc'
+
+    # Falls back to the default codec for values the codec can't encode
+    codecs.use_for_type(list, 'array')
+    assert codecs.encode('key', [1.5])[0] == 'array'
+    assert codecs.encode('key', [1, 'a'])[0] == 'pickle'
+    assert codecs.encode('key', {})[0] == 'pickle'
@@ -1,7 +1,7 @@
 """Test the string functions"""
 import pytest
 import os
-from rememberscript.strings import process_action, match_trigger
+from rememberscript.strings import process_action, match_trigger, compile_string
 
 async def dummy():
     yield 'hello'
@@ -108,3 +108,40 @@ async def test_match_trigger():
     storage = {}
     assert await match_trigger('hello world', 'hello world[[weight=2]]', storage) == True
     assert storage.get('weight', None) == 2
+
+def test_compile_string():
+    compiled = compile_string('[[a = 1]]hello {{a}}![[b = 2]]')
+    assert [ex.source for ex in compiled.execs] == ['a = 1', 'b = 2']
+    assert compiled.remainder == 'hello {{a}}!'
+    assert compiled.parts[0] == 'hello ' and compiled.parts[2] == '!'
+    assert compiled.parts[1].source == 'a'
+
+    # The same string is only compiled once
+    hits = compile_string.cache_info().hits
+    assert compile_string('[[a = 1]]hello {{a}}![[b = 2]]') is compiled
+    assert compile_string.cache_info().hits == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_spaced_blocks():
+    """Test that leading spaces in code blocks are ignored, like eval() does"""
+    storage = {}
+    result = [a async for a in process_action('a {{ "b" }} {{\t1 + 1 }}', storage)]
+    assert result == ['a b 2']
+    result = [a async for a in process_action('[[ hello = 42 ]]{{ hello }}', storage)]
+    assert result == [42] and storage['hello'] == 42
+    assert await match_trigger('hi', '{{ True }}[[ weight = 2 ]]', storage) == True
+    assert storage['weight'] == 2
+
+
+@pytest.mark.asyncio
+async def test_exec_coroutines():
+    compiled = compile_string('[[import os.path; a, b = x, dummy2(); f = {y for y in z}]]')
+    assert set(compiled.execs[0].assigned) == {'os', 'a', 'b', 'f'}
+
+    # Only coroutines assigned by the block are awaited
+    pending = dummy2()
+    storage = {'dummy2': dummy2, 'pending': pending}
+    result = [a async for a in process_action('[[result = dummy2()]]', storage)]
+    assert storage['result'] == 3 and storage['pending'] is pending
+    pending.close()
@@ -0,0 +1,67 @@
+import gc
+import asyncio
+import pytest
+from rememberscript.sync_scheduler import SyncScheduler
+
+class SlowStorage(dict):
+    running = 0
+    max_running = 0
+
+    def __init__(self):
+        self.syncs = 0
+
+    async def sync(self):
+        SlowStorage.running += 1
+        SlowStorage.max_running = max(SlowStorage.max_running, SlowStorage.running)
+        await asyncio.sleep(0.01)
+        SlowStorage.running -= 1
+        self.syncs += 1
+
+
+@pytest.mark.asyncio
+async def test_coalesce():
+    scheduler = SyncScheduler(delay=0.01)
+    storage = SlowStorage()
+    futures = [scheduler.schedule(storage) for _ in range(10)]
+    await asyncio.gather(*futures)
+    assert storage.syncs == 1
+    assert scheduler.requested == 10 and scheduler.coalesced == 9
+    assert scheduler.written == 1 and scheduler.max_write_time > 0
+
+    # A request while syncing results in another sync after it
+    scheduler.schedule(storage)
+    await scheduler.flush_all()
+    scheduler.schedule(storage)
+    await asyncio.sleep(0.015)
+    future = scheduler.schedule(storage)
+    await scheduler.flush_all()
+    assert future.done() and storage.syncs == 4
+
+
+@pytest.mark.asyncio
+async def test_max_writes():
+    scheduler = SyncScheduler(delay=10, max_writes=2)
+    storages = [SlowStorage() for _ in range(6)]
+    for storage in storages:
+        scheduler.schedule(storage)
+
+    # flush_all doesn't wait for the delay
+    await asyncio.wait_for(scheduler.flush_all(), 1)
+    assert all(storage.syncs == 1 for storage in storages)
+    assert SlowStorage.max_running == 2
+
+
+class FailingStorage:
+    async def sync(self):
+        raise OSError('disk full')
+
+
+@pytest.mark.asyncio
+async def test_failed_sync(caplog):
+    """Test that failures of syncs nobody awaits are only logged once"""
+    scheduler = SyncScheduler(delay=0)
+    scheduler.schedule(FailingStorage())
+    await scheduler.flush_all()
+    gc.collect()
+    assert scheduler.failed == 1 and 'sync failed' in caplog.text
+    assert 'never retrieved' not in caplog.text
@@ -0,0 +1,126 @@
+"""Test the timer wheel and timed triggers"""
+import os
+import asyncio
+import pytest
+from rememberscript import MachinePool, FileStorage
+from rememberscript.timers import TimerWheel, SessionTimers
+from rememberscript.testing import assert_replies
+
+def script_path(name):
+    return os.path.join(os.path.dirname(__file__), 'scripts/%s/' % name)
+
+
+class Clock:
+    """A clock that only moves when told to"""
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel():
+    fired = []
+    clock = Clock()
+    # A small wheel, so that the 0.1 s timer has to count down turns
+    wheel = TimerWheel(resolution=0.01, size=4, clock=clock)
+    wheel.schedule(0.1, fired.append, 'last')
+    wheel.schedule(0.02, fired.append, 'first')
+    cancelled = wheel.schedule(0.03, fired.append, 'cancelled')
+    async def coroutine(name):
+        fired.append(name)
+    wheel.schedule(0.05, coroutine, 'coroutine')
+    cancelled.cancel()
+    assert len(wheel) == 3
+
+    clock.now += 0.015
+    wheel.advance()
+    assert fired == []
+    clock.now += 0.04
+    wheel.advance()
+    await asyncio.sleep(0)
+    assert fired == ['first', 'coroutine']
+    # Timers fire up to one tick late
+    clock.now += 0.06
+    wheel.advance()
+    assert fired == ['first', 'coroutine', 'last']
+    assert len(wheel) == 0 and wheel._handle is None
+
+
+@pytest.mark.asyncio
+async def test_timed_triggers(tmpdir):
+    replies = asyncio.Queue()
+    async def on_timer(session_id, messages):
+        async for m in messages:
+            replies.put_nowait((session_id, m.content))
+
+    async def advance(wheel, clock, seconds):
+        clock.now += seconds
+        wheel.advance()
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def next_reply():
+        return await asyncio.wait_for(replies.get(), 5)
+
+    clock = Clock()
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    factory = lambda session_id: FileStorage(str(tmpdir.join('%s.bin' % session_id)))
+    timers = SessionTimers(wheel, FileStorage(str(tmpdir.join('timers.bin'))), clock=clock)
+    pool = await MachinePool.load(script_path('script12'), storage_factory=factory,
+                                  timers=timers, on_timer=on_timer)
+    await assert_replies(pool.reply('a', 'start'), 'waiting')
+    await advance(wheel, clock, 0.04)
+    assert replies.empty()
+    await advance(wheel, clock, 0.02)
+    assert await next_reply() == ('a', 'reminding')
+
+    # The periodic timer fires until the state is left
+    await advance(wheel, clock, 0.06)
+    assert await next_reply() == ('a', 'tick')
+    assert await next_reply() == ('a', 'reminding')
+    await assert_replies(pool.reply('a', 'stop'), 'stopped')
+    await advance(wheel, clock, 0.1)
+    assert replies.empty() and len(timers) == 0
+
+    # Pending timers are persisted
+    await assert_replies(pool.reply('b', 'start'), 'waiting')
+    await pool.close()
+    storage = FileStorage(str(tmpdir.join('timers.bin')))
+    await storage.load()
+    clock.now += 0.03
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    timers = SessionTimers(wheel, storage, clock=clock)
+    pool = await MachinePool.load(script_path('script12'), storage_factory=factory,
+                                  timers=timers, on_timer=on_timer)
+    pool.restore_timers()
+    await advance(wheel, clock, 0.01)
+    assert replies.empty()
+    await advance(wheel, clock, 0.02)
+    assert await next_reply() == ('b', 'reminding')
+
+
+@pytest.mark.asyncio
+async def test_reload_timers(tmpdir):
+    """Test that pending timers follow their state when the script changes"""
+    replies = asyncio.Queue()
+    async def on_timer(session_id, messages):
+        async for m in messages:
+            replies.put_nowait((session_id, m.content))
+
+    scripts = tmpdir.mkdir('scripts')
+    story = open(os.path.join(script_path('script12'), 'init.yaml')).read()
+    scripts.join('init.yaml').write(story)
+    clock = Clock()
+    wheel = TimerWheel(resolution=0.01, clock=clock)
+    pool = await MachinePool.load(str(scripts), timers=SessionTimers(wheel, clock=clock),
+                                  on_timer=on_timer)
+    await assert_replies(pool.reply('a', 'start'), 'waiting')
+
+    # A new state before the one with the pending timer
+    scripts.join('init.yaml').write(story.replace('- name: waiting', '- name: new\n- name: waiting'))
+    assert await pool.reload(str(scripts)) == ['init']
+    clock.now += 0.06
+    wheel.advance()
+    assert await asyncio.wait_for(replies.get(), 5) == ('a', 'reminding')
@@ -2,12 +2,15 @@ import json
 import pytest
 import logging
 from types import FunctionType
+from .messages import Message
 
 logger = logging.getLogger('rememberscript')
 
 async def assert_replies(replies, *correct, debug_print=False):
     for reply in correct:
-        n = json.loads(await replies.__anext__())
+        n = await replies.__anext__()
+        # Either a Message from replies() or an encoded reply from reply()
+        n = n.to_dict() if isinstance(n, Message) else json.loads(n)
         if reply is None:
             continue
         if isinstance(reply, str):
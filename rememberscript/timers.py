@@ -0,0 +1,254 @@
+"""
+A hashed timer wheel shared by all sessions, for the timed and periodic
+triggers of states (see the 'timer' state key)
+
+Timers are kept in a ring of slots, one per tick of resolution seconds, and
+a timer further away than one turn of the ring counts down the turns it has
+left. Inserting and cancelling a timer is O(1) regardless of the number of
+pending timers, and a single call_later drives the whole wheel.
+"""
+import math
+import time
+import asyncio
+import inspect
+import logging
+import traceback
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+from .script import CompiledTimer
+from .storage import StorageType
+
+logger = logging.getLogger('rememberscript')
+
+
+class Timer:
+    """A pending callback of a TimerWheel
+
+    deadline -- the event loop time the timer fires at (rounded up to a tick)
+    """
+    __slots__ = ('deadline', 'callback', 'args', '_rounds', '_slot', '_wheel')
+
+    def __init__(self, wheel: 'TimerWheel', deadline: float, rounds: int,
+                 callback: Callable, args: tuple) -> None:
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self._rounds = rounds
+        self._slot: Union[Dict['Timer', None], None] = None
+        self._wheel = wheel
+
+    @property
+    def pending(self) -> bool:
+        return self._slot is not None
+
+    def cancel(self) -> None:
+        """Cancels the timer, does nothing if it already fired"""
+        if self._slot is not None:
+            del self._slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+
+
+class TimerWheel:
+    """Runs callbacks after a delay, with a precision of resolution seconds
+
+    size -- number of slots, timers up to size * resolution seconds away
+            are found without counting down turns
+    clock -- if given, a function returning the current time in seconds
+             that the wheel uses instead of the event loop's time. The wheel
+             then isn't driven by the event loop, advance() has to be called
+             when the clock moved, e.g. by tests
+    """
+    def __init__(self, resolution: float=0.1, size: int=4096,
+                 clock: Optional[Callable[[], float]]=None) -> None:
+        self.resolution = resolution
+        self._slots: List[Dict[Timer, None]] = [{} for _ in range(size)]
+        self._clock = clock
+        # Time of tick 0 and the last tick that was processed
+        self._start: Union[float, None] = None
+        self._tick = 0
+        self._count = 0
+        self._handle: Union[asyncio.TimerHandle, None] = None
+
+    def __len__(self) -> int:
+        """Number of pending timers"""
+        return self._count
+
+    def schedule(self, delay: float, callback: Callable, *args: Any) -> Timer:
+        """Calls callback(*args) after delay seconds, callback can be a
+        coroutine function. Returns the Timer, which can be cancelled"""
+        now = self._now()
+        if self._start is None:
+            self._start = now
+        if self._count == 0:
+            # Skip the ticks while the wheel was idle
+            self._tick = self._current_tick(now)
+
+        tick = max(self._tick + 1, math.ceil((now + delay - self._start) / self.resolution))
+        rounds = (tick - self._tick - 1) // len(self._slots)
+        timer = Timer(self, self._start + tick * self.resolution, rounds, callback, args)
+        timer._slot = self._slots[tick % len(self._slots)]
+        timer._slot[timer] = None
+        self._count += 1
+
+        if self._handle is None and self._clock is None:
+            self._handle = asyncio.get_event_loop().call_later(self.resolution, self._advance)
+        return timer
+
+    def stop(self) -> None:
+        """Stops the wheel, pending timers fire once a timer is scheduled again"""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _now(self) -> float:
+        return self._clock() if self._clock is not None else asyncio.get_event_loop().time()
+
+    def _current_tick(self, now: float) -> int:
+        assert self._start is not None
+        return int((now - self._start) / self.resolution)
+
+    def advance(self) -> None:
+        """Fires the timers that are due, for wheels with a custom clock"""
+        self._process(self._current_tick(self._now()))
+
+    def _advance(self) -> None:
+        """Processes the slots of the ticks that have passed and schedules
+        the next tick"""
+        assert self._start is not None
+        loop = asyncio.get_event_loop()
+        target = self._current_tick(loop.time())
+        self._process(target)
+        if self._count > 0:
+            # Schedule the next tick relative to tick 0, so ticks don't drift
+            delay = self._start + (target + 1) * self.resolution - loop.time()
+            self._handle = loop.call_later(max(0.0, delay), self._advance)
+        else:
+            self._handle = None
+
+    def _process(self, target: int) -> None:
+        while self._tick < target and self._count > 0:
+            self._tick += 1
+            slot = self._slots[self._tick % len(self._slots)]
+            for timer in list(slot):
+                if timer._rounds > 0:
+                    timer._rounds -= 1
+                    continue
+                timer.cancel()
+                self._fire(timer)
+
+    def _fire(self, timer: Timer) -> None:
+        try:
+            result = timer.callback(*timer.args)
+            if inspect.isawaitable(result):
+                asyncio.ensure_future(result).add_done_callback(_log_error)
+        except:
+            logger.error('timer callback failed')
+            logger.error(traceback.format_exc())
+
+
+# (story name, position) of the state a timer belongs to
+TimerKey = Tuple[str, int]
+FireCallback = Callable[[Hashable, TimerKey], Any]
+
+
+class SessionTimers:
+    """The timer of the current state of every session, see the 'timer'
+    state key. A state's timer starts when a session enters the state and is
+    cancelled when it leaves it. Used by MachinePool.
+
+    wheel -- the TimerWheel to use, can be shared
+    storage -- if given, e.g. a FileStorage, pending timers are stored in it
+               as [wall clock deadline, story name, position] by session id
+               (which then have to be str), so that restore() can schedule
+               them again after a restart
+    clock -- the wall clock for the stored deadlines
+    """
+    def __init__(self, wheel: Optional[TimerWheel]=None, storage: Optional[StorageType]=None,
+                 clock: Callable[[], float]=time.time) -> None:
+        self.wheel = wheel if wheel is not None else TimerWheel()
+        self.storage = storage
+        self._clock = clock
+        # The timer of each session and the state it belongs to, the timer
+        # is None if it fired and won't fire again in that state
+        self._timers: Dict[Hashable, Tuple[Optional[Timer], TimerKey]] = {}
+
+    def __len__(self) -> int:
+        """Number of pending timers"""
+        return sum(1 for timer, _ in self._timers.values()
+                   if timer is not None and timer.pending)
+
+    def update(self, session_id: Hashable, key: TimerKey, timer: Optional[CompiledTimer],
+               fired: Optional[TimerKey], callback: FireCallback) -> None:
+        """Called when a session has processed a message
+
+        key, timer -- the state the session is in now and its timer
+        fired -- the state whose timer message was processed, if any
+        callback -- called with (session_id, key) when the timer fires
+        """
+        current = self._timers.get(session_id, None)
+        if current is not None and current[1] == key and fired != key:
+            # Still in the same state, its timer keeps running
+            return
+
+        self.cancel(session_id)
+        if timer is None:
+            return
+        if fired == key:
+            if timer.interval is None:
+                self._timers[session_id] = (None, key)
+                return
+            delay = timer.interval
+        else:
+            delay = timer.delay
+
+        self._timers[session_id] = (self.wheel.schedule(delay, callback, session_id, key), key)
+        if self.storage is not None:
+            assert isinstance(session_id, str), 'Persisted timers need str session ids'
+            self.storage[session_id] = [self._clock() + delay] + list(key)
+
+    def remap(self, remap: Callable[[TimerKey], Optional[TimerKey]]) -> None:
+        """Moves the timers to the states they belong to after a script
+        reload, remap returns the new key of a state or None if it's gone"""
+        for session_id, (timer, key) in list(self._timers.items()):
+            new_key = remap(key)
+            if new_key is None:
+                self.cancel(session_id)
+            elif new_key != key:
+                if timer is not None:
+                    timer.args = (session_id, new_key)
+                self._timers[session_id] = (timer, new_key)
+                if (self.storage is not None and isinstance(session_id, str) and
+                        session_id in self.storage):
+                    self.storage[session_id] = self.storage[session_id][:1] + list(new_key)
+
+    def cancel(self, session_id: Hashable) -> None:
+        current = self._timers.pop(session_id, None)
+        if current is None:
+            return
+        if current[0] is not None:
+            current[0].cancel()
+        if self.storage is not None and isinstance(session_id, str) and session_id in self.storage:
+            del self.storage[session_id]
+
+    def stop(self) -> None:
+        """Cancels all timers but keeps them in storage, for shutting down"""
+        for timer, _ in self._timers.values():
+            if timer is not None:
+                timer.cancel()
+        self._timers.clear()
+
+    def restore(self, callback: FireCallback) -> None:
+        """Schedules the timers in storage, timers that are overdue fire
+        on the next tick"""
+        assert self.storage is not None, 'Only stored timers can be restored'
+        for session_id, (deadline, story, position) in list(self.storage.items()):
+            key = (story, position)
+            delay = max(0.0, deadline - self._clock())
+            self._timers[session_id] = (self.wheel.schedule(delay, callback, session_id, key), key)
+
+
+def _log_error(future: asyncio.Future) -> None:
+    error = future.exception() if not future.cancelled() else None
+    if error is not None:
+        logger.error('timer callback failed')
+        logger.error(''.join(traceback.format_exception(type(error), error, error.__traceback__)))